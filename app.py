@@ -1,11 +1,25 @@
-from flask import Flask, render_template, request, jsonify, session
+# eventlet must patch the stdlib before anything else imports socket/threading
+import eventlet
+eventlet.monkey_patch()
+
+from flask import Flask, render_template, request, jsonify, session, g as flask_g
+from flask.json.provider import DefaultJSONProvider
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import chess
 import chess.engine
+import chess.polyglot
 import time
 import random
 import secrets
 import threading
+import queue
+import logging
+import logging.handlers
+import sys
+import atexit
+import heapq
+import itertools
+from collections import OrderedDict
 import os
 from datetime import datetime, timedelta
 import shutil
@@ -13,18 +27,42 @@ import hashlib
 import hmac
 import json
 
+# ===== LOGGING =====
+# Socket handlers log through a QueueHandler; a QueueListener thread does the
+# actual stdout writes, and %-style arguments are only formatted when emitted.
+# Set up before importing database, whose "chess.db" logger reports through
+# this one from import time on.
+log = logging.getLogger("chess")
+log.setLevel(logging.INFO)
+log.propagate = False
+_log_queue = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter("%(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 # Import database functions
 from database import (
     init_db_pool, get_db_conn, release_db_conn,
     increment_visitor_count, get_total_visitor_count,
     get_leaderboard_data, save_game_record,
     get_user_by_id, get_user_by_username, get_user_by_email, create_user,
-    update_last_login, update_user_password, get_user_profile, get_user_games,
+    update_last_login, update_user_password, get_user_profile, get_user_games, USER_GAMES_PAGE_SIZE,
     get_game_replay, create_reset_code, verify_reset_code, mark_reset_code_used,
     create_verification_code, verify_email_code, mark_email_verified,
-    check_username_exists, check_email_exists
+    check_username_exists, check_email_exists,
+    get_cached_engine_move, queue_engine_move,
+    GAMES_COLUMNS, SQL_MIGRATE_GAMES
 )
 
+# orjson is optional; fall back to the stdlib json module without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Email imports - using HTTP API (Resend) for Railway compatibility
 import urllib.request
 import urllib.error
@@ -35,7 +73,35 @@ app.config["SECRET_KEY"] = secrets.token_hex(16)
 app.config["SESSION_COOKIE_SECURE"] = False  # Set to True in production with HTTPS
 app.config["SESSION_COOKIE_HTTPONLY"] = True
 app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
+
+class OrjsonWrapper:
+    """json-module stand-in for python-socketio, backed by orjson"""
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        return orjson.loads(s)
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson; dates still use Flask's format"""
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+# WebSocket frames get permessage-deflate from eventlet's handshake whenever
+# the browser offers it; long-polling responses are compressed from 512 bytes,
+# which covers a full game state.
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode="eventlet",
+                    json=OrjsonWrapper if orjson is not None else json,
+                    http_compression=True, compression_threshold=512)
 
 # ===== EMAIL CONFIGURATION =====
 # Using Brevo (Sendinblue) API - works on Railway, no domain verification required
@@ -225,14 +291,19 @@ def get_current_user():
     """Get current logged in user from session (for HTTP routes only)"""
     try:
         user_id = session.get('user_id')
-        print(f"🔍 get_current_user() - session user_id: {user_id}")
+        log.debug("🔍 get_current_user() - session user_id: %s", user_id)
         if not user_id:
             return None
+        # Memoized per request; keyed by user_id so login/logout mid-request is safe
+        cached = flask_g.get("current_user")
+        if cached and cached[0] == user_id:
+            return cached[1]
         user = get_user_by_id(user_id)
-        print(f"🔍 get_current_user() - found user: {user['username'] if user else None}")
+        log.debug("🔍 get_current_user() - found user: %s", user['username'] if user else None)
+        flask_g.current_user = (user_id, user)
         return user
     except Exception as e:
-        print(f"⚠️ get_current_user() error: {e}")
+        log.warning("⚠️ get_current_user() error: %s", e)
         return None
 
 def get_socketio_user(sid=None):
@@ -243,7 +314,7 @@ def get_socketio_user(sid=None):
     # First try from our sid_to_user cache
     if sid in sid_to_user:
         user_info = sid_to_user[sid]
-        print(f"🔍 get_socketio_user({sid}) - from cache: {user_info}")
+        log.debug("🔍 get_socketio_user(%s) - from cache: %s", sid, user_info)
         return user_info
 
     # Fall back to Flask session (may work in some cases)
@@ -254,12 +325,12 @@ def get_socketio_user(sid=None):
             if user:
                 # Cache it for future use
                 sid_to_user[sid] = {'id': user['id'], 'username': user['username']}
-                print(f"🔍 get_socketio_user({sid}) - from session: {user['username']}")
+                log.debug("🔍 get_socketio_user(%s) - from session: %s", sid, user['username'])
                 return sid_to_user[sid]
     except Exception as e:
-        print(f"⚠️ get_socketio_user() session fallback error: {e}")
+        log.warning("⚠️ get_socketio_user() session fallback error: %s", e)
 
-    print(f"🔍 get_socketio_user({sid}) - no user found")
+    log.debug("🔍 get_socketio_user(%s) - no user found", sid)
     return None
 
 # Initialize database on startup
@@ -293,15 +364,86 @@ else:
     print("   Linux: sudo apt-get install stockfish")
     print("   Or download from: https://stockfishchess.org/download/")
 
+# ===== STOCKFISH ENGINE POOL =====
+# Warm engine processes shared by all bot games, started on first use
+ENGINE_POOL_SIZE = int(os.environ.get("ENGINE_POOL_SIZE", 2))
+engine_pool = queue.Queue()
+engine_pool_lock = threading.Lock()
+engines_started = 0
+
+def acquire_engine():
+    """Borrow an idle Stockfish process, starting one while the pool has room"""
+    global engines_started
+    with engine_pool_lock:
+        spawn = engine_pool.empty() and engines_started < ENGINE_POOL_SIZE
+        if spawn:
+            engines_started += 1
+    if not spawn:
+        return engine_pool.get()
+    try:
+        return chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
+    except Exception:
+        with engine_pool_lock:
+            engines_started -= 1
+        raise
+
+def release_engine(engine, broken=False):
+    """Return an engine to the pool, or retire it if it failed"""
+    global engines_started
+    if not broken:
+        engine_pool.put(engine)
+        return
+    try:
+        engine.quit()
+    except Exception:
+        pass
+    with engine_pool_lock:
+        engines_started -= 1
+
+@atexit.register
+def shutdown_engines():
+    while not engine_pool.empty():
+        try:
+            engine_pool.get_nowait().quit()
+        except Exception:
+            pass
+
 games = {}
+# Single-key dict reads/writes are atomic in CPython, so handlers use
+# sid_to_room without a lock
 sid_to_room = {}
 sid_to_user = {}  # Maps socket ID to user info for SocketIO contexts
 DISCONNECT_TIMEOUT = 15.0
 
 # ===== GLOBAL MATCHMAKING QUEUE =====
-matchmaking_queue = []
+# One insertion-ordered bucket per time control, so pairing, cancel and
+# disconnect are all O(1) and the longest-waiting player is matched first.
+matchmaking_queues = {}   # time_control -> OrderedDict of sid -> player
+matchmaking_waiting = {}  # sid -> player (carries its timeControl)
 matchmaking_lock = threading.Lock()
 
+def pop_matchmaking_peer(time_control):
+    """Pop the longest-waiting player for a time control (call under lock)"""
+    bucket = matchmaking_queues.get(time_control)
+    if not bucket:
+        return None
+    peer_sid, player = bucket.popitem(last=False)
+    if not bucket:
+        del matchmaking_queues[time_control]
+    del matchmaking_waiting[peer_sid]
+    return player
+
+def remove_from_matchmaking(sid):
+    """Drop a sid from the queue if it's waiting (call under lock)"""
+    player = matchmaking_waiting.pop(sid, None)
+    if player:
+        bucket = matchmaking_queues.get(player["timeControl"])
+        if bucket is not None:
+            bucket.pop(sid, None)
+            if not bucket:
+                del matchmaking_queues[player["timeControl"]]
+    return player
+
 # --- ROUTES ---
 @app.route("/")
 def index():
@@ -337,7 +479,7 @@ def active_games_api():
                 "room": room,
                 "whiteName": g.get("white_player", "White"),
                 "blackName": g.get("black_player", "Black"),
-                "spectators": len(g.get("spectators", set())),
+                "spectators": spectator_count(g),
                 "gameMode": g.get("game_mode", "friend")
             })
     return jsonify(active)
@@ -403,14 +545,7 @@ def verify_registration():
     if not reg_data:
         return jsonify({'error': 'Invalid or expired code'}), 400
 
-    # Check again if username/email was taken in the meantime
-    if check_username_exists(reg_data['username']):
-        return jsonify({'error': 'Username already taken'}), 409
-
-    if check_email_exists(email):
-        return jsonify({'error': 'Email already registered'}), 409
-
-    # Create user
+    # Create user; the insert itself refuses a username/email taken meanwhile
     user_id = create_user(
         reg_data['username'],
         email,
@@ -419,6 +554,11 @@ def verify_registration():
     )
 
     if not user_id:
+        # Only on failure: find out which constraint got in the way
+        if check_username_exists(reg_data['username']):
+            return jsonify({'error': 'Username already taken'}), 409
+        if check_email_exists(email):
+            return jsonify({'error': 'Email already registered'}), 409
         return jsonify({'error': 'Registration failed'}), 500
 
     # Mark verification code as used
@@ -598,11 +738,7 @@ def debug_recent_games():
     """Debug endpoint to see recent games and user_ids"""
     conn = get_db_conn()
     try:
-        if os.environ.get('DATABASE_URL'):
-            from psycopg2.extras import RealDictCursor
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-        else:
-            cur = conn.cursor()
+        cur = conn.cursor()
 
         cur.execute("""
             SELECT id, room_code, white_player, black_player,
@@ -612,8 +748,8 @@ def debug_recent_games():
             ORDER BY created_at DESC
             LIMIT 10
         """)
-        rows = cur.fetchall()
-        recent_games = [dict(row) for row in rows]
+        # Rows are already plain dicts on both backends
+        recent_games = cur.fetchall()
 
         # Convert datetime to string for JSON serialization
         for game in recent_games:
@@ -625,6 +761,8 @@ def debug_recent_games():
         import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
+    finally:
+        release_db_conn(conn)
 
 @app.route('/api/debug/test-db-write')
 def debug_test_db_write():
@@ -643,7 +781,7 @@ def debug_test_db_write():
                 RETURNING id
             """, ('test-debug-room', 'TestWhite', 'TestBlack', 'white', 'test', 'debug', 300, 0))
             result = cur.fetchone()
-            game_id = result[0] if result else None
+            game_id = result['id'] if result else None
         else:
             cur.execute("""
                 INSERT INTO games (
@@ -666,6 +804,8 @@ def debug_test_db_write():
         traceback.print_exc()
         conn.rollback()
         return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        release_db_conn(conn)
 
 @app.route('/api/debug/active-rooms')
 def debug_active_rooms():
@@ -697,31 +837,9 @@ def debug_migrate_games_table():
         cur = conn.cursor()
         migrations = []
 
-        # Check and add missing columns to games table
-        columns_to_add = [
-            ("room_code", "VARCHAR(100)"),
-            ("white_player", "VARCHAR(100)"),
-            ("black_player", "VARCHAR(100)"),
-            ("white_user_id", "INTEGER REFERENCES users(id)"),
-            ("black_user_id", "INTEGER REFERENCES users(id)"),
-            ("winner", "VARCHAR(20)"),
-            ("win_reason", "VARCHAR(50)"),
-            ("game_mode", "VARCHAR(20)"),
-            ("time_control", "INTEGER"),
-            ("start_time", "TIMESTAMP"),
-            ("end_time", "TIMESTAMP"),
-            ("move_count", "INTEGER DEFAULT 0"),
-            ("created_at", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"),
-        ]
-
-        for col_name, col_type in columns_to_add:
-            try:
-                cur.execute(f"""
-                    ALTER TABLE games ADD COLUMN IF NOT EXISTS {col_name} {col_type}
-                """)
-                migrations.append(f"Added/verified column: {col_name}")
-            except Exception as e:
-                migrations.append(f"Column {col_name}: {str(e)}")
+        # Add any missing columns to games table in one statement
+        cur.execute(SQL_MIGRATE_GAMES)
+        migrations.append(f"Added/verified columns: {', '.join(name for name, _ in GAMES_COLUMNS)}")
 
         conn.commit()
 
@@ -732,7 +850,7 @@ def debug_migrate_games_table():
             WHERE table_name = 'games'
             ORDER BY ordinal_position
         """)
-        columns = [{'name': row[0], 'type': row[1]} for row in cur.fetchall()]
+        columns = [{'name': row['column_name'], 'type': row['data_type']} for row in cur.fetchall()]
 
         return jsonify({
             'success': True,
@@ -745,9 +863,7 @@ def debug_migrate_games_table():
         conn.rollback()
         return jsonify({'error': str(e)}), 500
     finally:
-        if os.environ.get('DATABASE_URL'):
-            from database import release_db_conn
-            release_db_conn(conn)
+        release_db_conn(conn)
 
 @app.route('/api/user/<username>')
 def get_user_profile_api(username):
@@ -759,11 +875,25 @@ def get_user_profile_api(username):
 
 @app.route('/api/user/<username>/games')
 def get_user_games_api(username):
-    """Get user's game history"""
-    games = get_user_games(username)
+    """Get user's game history, newest first; pass ?before=<next_cursor> for older pages"""
+    before = request.args.get('before')
+    if before:
+        # "<end_time>|<id>" of the last game on the previous page
+        end_time, _, game_id = before.rpartition('|')
+        try:
+            before = (datetime.fromisoformat(end_time), int(game_id))
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+    games = get_user_games(username, before or None)
     if games is None:
         return jsonify({'error': 'User not found'}), 404
-    return jsonify({'games': games}), 200
+    next_cursor = None
+    if len(games) == USER_GAMES_PAGE_SIZE:
+        end_time = games[-1]['end_time']
+        if isinstance(end_time, datetime):
+            end_time = end_time.isoformat(sep=' ')
+        next_cursor = f"{end_time}|{games[-1]['id']}"
+    return jsonify({'games': games, 'next_cursor': next_cursor}), 200
 
 @app.route('/api/game/<int:game_id>/replay')
 def get_game_replay_api(game_id):
@@ -784,13 +914,13 @@ def on_connect():
             user = get_user_by_id(user_id)
             if user:
                 sid_to_user[sid] = {'id': user['id'], 'username': user['username']}
-                print(f"🔗 SocketIO connected: {sid} -> user: {user['username']} (id: {user['id']})")
+                log.info("🔗 SocketIO connected: %s -> user: %s (id: %s)", sid, user['username'], user['id'])
             else:
-                print(f"🔗 SocketIO connected: {sid} -> user_id {user_id} not found in DB")
+                log.info("🔗 SocketIO connected: %s -> user_id %s not found in DB", sid, user_id)
         else:
-            print(f"🔗 SocketIO connected: {sid} -> guest (no session)")
+            log.info("🔗 SocketIO connected: %s -> guest (no session)", sid)
     except Exception as e:
-        print(f"⚠️ on_connect error: {e}")
+        log.warning("⚠️ on_connect error: %s", e)
 
 @socketio.on("authenticate")
 def on_authenticate(data):
@@ -802,28 +932,28 @@ def on_authenticate(data):
         try:
             user_id = int(user_id)
         except (ValueError, TypeError):
-            print(f"❌ Invalid user_id format: {user_id}")
+            log.error("❌ Invalid user_id format: %s", user_id)
             emit("authenticated", {"success": False})
             return
 
         user = get_user_by_id(user_id)
         if user:
             sid_to_user[sid] = {'id': user['id'], 'username': user['username']}
-            print(f"✅ SocketIO authenticated: {sid} -> user: {user['username']} (id: {user['id']})")
+            log.info("✅ SocketIO authenticated: %s -> user: %s (id: %s)", sid, user['username'], user['id'])
             emit("authenticated", {"success": True, "username": user['username']})
 
             # If already in a game, update the user_id linkage
             room = sid_to_room.get(sid)
-            if room and room in games:
-                g = games[room]
+            g = games.get(room) if room else None
+            if g is not None:
                 if sid == g.get("white_sid") and not g.get("white_user_id"):
                     g["white_user_id"] = user['id']
-                    print(f"🔗 Late-linked white player to user_id: {user['id']}")
+                    log.info("🔗 Late-linked white player to user_id: %s", user['id'])
                 elif sid == g.get("black_sid") and not g.get("black_user_id"):
                     g["black_user_id"] = user['id']
-                    print(f"🔗 Late-linked black player to user_id: {user['id']}")
+                    log.info("🔗 Late-linked black player to user_id: %s", user['id'])
             return
-    print(f"❌ SocketIO authentication failed for {sid}")
+    log.error("❌ SocketIO authentication failed for %s", sid)
     emit("authenticated", {"success": False})
 
 # --- CHESS LOGIC ---
@@ -831,56 +961,134 @@ def format_seconds(sec):
     total = int(max(0, round(sec)))
     return f"{total//60}:{total%60:02d}"
 
+# Square index -> (row, col) on the client grid, and its "row,col" move-map key
+SQ_TO_RC = [(7 - (sq >> 3), sq & 7) for sq in range(64)]
+SQ_TO_KEY = [f"{r},{c}" for r, c in SQ_TO_RC]
+
+# Piece code (piece_type, +6 for black) -> client symbol
+PIECE_CHAR = ['.', 'P', 'N', 'B', 'R', 'Q', 'K', 'p', 'n', 'b', 'r', 'q', 'k']
+
 def board_to_matrix(board):
-    grid = [["." for _ in range(8)] for _ in range(8)]
+    # Fill a flat numeric board, then map to symbols once per square
+    arr = bytearray(64)
     for sq, piece in board.piece_map().items():
-        grid[7 - chess.square_rank(sq)][chess.square_file(sq)] = piece.symbol()
-    return grid
+        arr[sq] = piece.piece_type if piece.color else piece.piece_type + 6
+    chars = PIECE_CHAR
+    return [[chars[arr[(7 - r) * 8 + c]] for c in range(8)] for r in range(8)]
 
 def get_legal_moves_map(board):
     """Pre-calculates all legal moves mapped by starting square (row,col)"""
+    t = SQ_TO_RC
+    keys = SQ_TO_KEY
     moves = {}
     for move in board.legal_moves:
-        r_from = 7 - chess.square_rank(move.from_square)
-        c_from = chess.square_file(move.from_square)
-        r_to = 7 - chess.square_rank(move.to_square)
-        c_to = chess.square_file(move.to_square)
-        
-        key = f"{r_from},{c_from}"
-        if key not in moves:
-            moves[key] = []
-        moves[key].append({"row": r_to, "col": c_to})
+        r_to, c_to = t[move.to_square]
+        moves.setdefault(keys[move.from_square], []).append({"row": r_to, "col": c_to})
     return moves
 
+# Grid + legal-move map per position, keyed by 64-bit Zobrist hash
+POSITION_CACHE_SIZE = 4096
+position_cache = OrderedDict()
+
+def position_key(g):
+    """Zobrist hash of the game's current position, computed once per move"""
+    if g.get("zobrist") is None:
+        g["zobrist"] = chess.polyglot.zobrist_hash(g["board"])
+    return g["zobrist"]
+
+def _matrix_moves_for_position(g):
+    """Board grid and legal-move map for a position, shared by every client"""
+    key = position_key(g)
+    cached = position_cache.get(key)
+    if cached is not None:
+        position_cache.move_to_end(key)
+        return cached
+    cached = (board_to_matrix(g["board"]), get_legal_moves_map(g["board"]))
+    position_cache[key] = cached
+    if len(position_cache) > POSITION_CACHE_SIZE:
+        position_cache.popitem(last=False)
+    return cached
+
+def random_legal_move(board):
+    """Pick a uniformly random legal move without building the move list"""
+    chosen = None
+    for i, m in enumerate(board.generate_legal_moves(), 1):
+        # Reservoir sampling: keep the i-th move with probability 1/i
+        if random.random() * i < 1.0:
+            chosen = m
+    return chosen
+
 def check_game_over(board):
     """
     Check if the game is over and return (winner, reason) tuple.
     Returns (None, None) if game is not over.
     """
-    if board.is_checkmate():
-        winner = "white" if not board.turn else "black"
-        return (winner, "checkmate")
-
-    if board.is_stalemate():
+    # One legal-move generation answers both checkmate and stalemate
+    if not any(board.generate_legal_moves()):
+        if board.is_check():
+            winner = "white" if not board.turn else "black"
+            return (winner, "checkmate")
         return ("draw", "stalemate")
 
     if board.is_insufficient_material():
         return ("draw", "insufficient")
 
+    # Repetition and the fifty-move rule only need the move stack once enough
+    # reversible moves have been played (a threefold needs at least 8 plies)
+    if board.halfmove_clock < 8:
+        return (None, None)
+
     # Threefold repetition - automatic draw
     if board.is_repetition(3):
         return ("draw", "repetition")
 
     # Fifty-move rule
-    if board.is_fifty_moves():
+    if board.halfmove_clock >= 100:
         return ("draw", "fifty_moves")
 
     return (None, None)
 
+def new_game(white_player, black_player, white_sid, black_sid, time_control,
+             game_mode, white_user_id=None, black_user_id=None,
+             bot_difficulty=None, is_active=True):
+    """Build the state dict for a fresh game room."""
+    now = time.time()
+    g = {
+        "board": chess.Board(),
+        "whiteTime": float(time_control),
+        "blackTime": float(time_control),
+        "lastUpdate": now,
+        "start_timestamp": datetime.utcfromtimestamp(now),
+        "isActive": is_active,
+        "winner": None,
+        "bot": game_mode == "bot",
+        "lock": threading.Lock(),
+        "white_player": white_player,
+        "black_player": black_player,
+        "white_sid": white_sid,
+        "black_sid": black_sid,
+        "white_user_id": white_user_id,
+        "black_user_id": black_user_id,
+        "white_disconnect_timer": None,
+        "black_disconnect_timer": None,
+        # sid -> "white" / "black" / "spectator" for everyone in the room
+        "clients": {sid: color for sid, color in ((white_sid, "white"), (black_sid, "black")) if sid},
+        "game_mode": game_mode,
+        "move_history": []
+    }
+    if bot_difficulty:
+        g["bot_difficulty"] = bot_difficulty
+    return g
+
+def spectator_count(g):
+    """Number of spectators in a game room"""
+    return sum(color == "spectator" for color in g["clients"].values())
+
 def export_state(room, current_sid=None):
     g = games[room]
+    matrix, moves = _matrix_moves_for_position(g)
     state = {
-        "board": board_to_matrix(g["board"]),
+        "board": matrix,
         "turn": "white" if g["board"].turn else "black",
         "check": g["board"].is_check(),
         "winner": g["winner"],
@@ -890,10 +1098,11 @@ def export_state(room, current_sid=None):
         "blackTime": g["blackTime"],
         "whiteTimeFormatted": format_seconds(g["whiteTime"]),
         "blackTimeFormatted": format_seconds(g["blackTime"]),
-        "moves": get_legal_moves_map(g["board"]),
+        "moves": moves,
         "whiteName": g["white_player"],
         "blackName": g["black_player"],
-        "gameMode": g.get("game_mode", "friend")
+        "gameMode": g.get("game_mode", "friend"),
+        "ply": g["board"].ply()
     }
     
     if current_sid:
@@ -904,6 +1113,28 @@ def export_state(room, current_sid=None):
     
     return state
 
+def broadcast_state(room, event="game_update"):
+    """Send one shared state to everyone in the room; clients read names by color"""
+    socketio.emit(event, {"state": export_state(room)}, room=room)
+
+# Everything in a move broadcast besides the board and the player names
+DELTA_KEYS = ("turn", "check", "winner", "reason", "isActive", "whiteTime", "blackTime",
+              "whiteTimeFormatted", "blackTimeFormatted", "moves", "ply")
+
+def export_delta(room, before):
+    """Patch from the piece map `before` to the current state, for clients already in sync"""
+    state = export_state(room)
+    after = games[room]["board"].piece_map()
+    changed = []
+    for sq in before.keys() | after.keys():
+        piece = after.get(sq)
+        if before.get(sq) != piece:
+            r, c = SQ_TO_RC[sq]
+            changed.append([r, c, piece.symbol() if piece else "."])
+    delta = {k: state[k] for k in DELTA_KEYS}
+    delta["changed"] = changed
+    return delta
+
 def update_time(g):
     if not g.get("isActive") or g["winner"]: return
     now = time.time()
@@ -921,74 +1152,146 @@ def update_time(g):
             g["winner"] = "white"
             g["reason"] = "timeout"
 
+# Saves run as background tasks; cap how many hit the database at once so a
+# burst of finished games can't take every pooled connection from lookups
+SAVE_CONCURRENCY = 4
+save_slots = threading.BoundedSemaphore(SAVE_CONCURRENCY)
+
 def save_game(room, g):
-    """Save game using database.py function"""
-    if g.get("saved"):
-        print(f"⏭️ Game {room} already saved, skipping")
+    """Save game using database.py function (call via start_background_task)"""
+    if g.get("saved") or g.get("saving"):
+        log.debug("⏭️ Game %s already saved, skipping", room)
         return
+    # Claim the save so a background save and an inline one never both run
+    g["saving"] = True
 
     end_time = datetime.utcnow()
     start_time = g.get("start_timestamp", end_time)
     win_reason = g.get("reason", "unknown")
 
-    print(f"💾 save_game() called for room: {room}")
-    print(f"   white_user_id: {g.get('white_user_id')}, black_user_id: {g.get('black_user_id')}")
-    print(f"   winner: {g.get('winner')}, reason: {win_reason}")
-    print(f"   game_mode: {g.get('game_mode')}, move_count: {len(g.get('move_history', []))}")
+    log.debug("💾 save_game() called for room: %s (white_user_id: %s, black_user_id: %s, "
+              "winner: %s, reason: %s, game_mode: %s, move_count: %d)",
+              room, g.get('white_user_id'), g.get('black_user_id'), g.get('winner'),
+              win_reason, g.get('game_mode'), len(g.get('move_history', [])))
 
     try:
-        success = save_game_record(room, g, start_time, end_time, win_reason)
+        with save_slots:
+            success = save_game_record(room, g, start_time, end_time, win_reason)
         if success:
             g["saved"] = True
-            print(f"✅ Game {room} saved successfully")
+            log.info("✅ Game %s saved successfully", room)
         else:
-            print(f"❌ save_game_record returned False for room {room}")
+            log.error("❌ save_game_record returned False for room %s", room)
     except Exception as e:
-        print(f"❌ Exception in save_game for room {room}: {e}")
-        import traceback
-        traceback.print_exc()
+        log.error("❌ Exception in save_game for room %s: %s", room, e,
+                  exc_info=log.isEnabledFor(logging.DEBUG))
+    finally:
+        g["saving"] = False
+
+# ===== CLOCK EXPIRY SCHEDULE =====
+# Min-heap of (deadline, generation, room). Rescheduling a game bumps its
+# generation, so superseded entries are skipped when they surface.
+clock_heap = []
+clock_cv = threading.Condition()
+clock_generations = itertools.count(1)
+
+def schedule_clock_expiry(room, g):
+    """Queue the moment the side to move runs out of time"""
+    if not g.get("isActive") or g["winner"]:
+        return
+    gen = next(clock_generations)
+    g["clock_gen"] = gen
+    remaining = g["whiteTime"] if g["board"].turn else g["blackTime"]
+    with clock_cv:
+        heapq.heappush(clock_heap, (g["lastUpdate"] + remaining, gen, room))
+        clock_cv.notify()
 
 def timeout_watcher():
+    """Sleep until the earliest flag can fall instead of polling every game"""
     while True:
-        time.sleep(1)
-        for r, g in list(games.items()):
-            if g.get("isActive") and not g["winner"]:
-                with g["lock"]:
-                    update_time(g)
-                    if g["winner"]:
-                        save_game(r, g)
-                        for sid in g.get("clients", set()):
-                            socketio.emit("game_update", {"state": export_state(r, sid)}, room=sid)
-
-timeout_thread = threading.Thread(target=timeout_watcher, daemon=True)
-timeout_thread.start()
-
-def handle_disconnect_timeout(room, color):
-    if room not in games: return
-    g = games[room]
+        with clock_cv:
+            while not clock_heap:
+                clock_cv.wait()
+            deadline, gen, r = clock_heap[0]
+            delay = deadline - time.time()
+            if delay > 0:
+                clock_cv.wait(timeout=delay)
+                continue
+            heapq.heappop(clock_heap)
+
+        g = games.get(r)
+        if g is None or g.get("clock_gen") != gen:
+            continue
+        with g["lock"]:
+            if not g.get("isActive") or g["winner"]:
+                continue
+            update_time(g)
+            if g["winner"]:
+                broadcast_state(r)
+                socketio.start_background_task(save_game, r, g)
+            else:
+                schedule_clock_expiry(r, g)
+
+socketio.start_background_task(timeout_watcher)
+
+# ===== DISCONNECT REAPER =====
+# Min-heap of (deadline, generation, room, color) served by one reaper task.
+# The generation is stored as the player's disconnect timer; a reconnect
+# clears it, so the entry is ignored when it comes due.
+disconnect_heap = []
+disconnect_cv = threading.Condition()
+disconnect_generations = itertools.count(1)
+
+def start_disconnect_timer(room, g, color):
+    """Begin the abandonment countdown for a disconnected player"""
+    gen = next(disconnect_generations)
+    g[f"{color}_disconnect_timer"] = gen
+    with disconnect_cv:
+        heapq.heappush(disconnect_heap, (time.time() + DISCONNECT_TIMEOUT, gen, room, color))
+        disconnect_cv.notify()
+
+def disconnect_reaper():
+    """Sleep until the earliest disconnect deadline, then settle it"""
+    while True:
+        with disconnect_cv:
+            while not disconnect_heap:
+                disconnect_cv.wait()
+            deadline, gen, room, color = disconnect_heap[0]
+            delay = deadline - time.time()
+            if delay > 0:
+                disconnect_cv.wait(timeout=delay)
+                continue
+            heapq.heappop(disconnect_heap)
+        handle_disconnect_timeout(room, color, gen)
+
+socketio.start_background_task(disconnect_reaper)
+
+def handle_disconnect_timeout(room, color, timer):
+    g = games.get(room)
+    if g is None: return
     
     with g["lock"]:
         if g["winner"]: return
-        if color == "white" and g.get("white_disconnect_timer"):
+        # A reconnect clears the timer; a later disconnect starts a new one
+        if color == "white" and g.get("white_disconnect_timer") == timer:
             g["winner"] = "black"
             g["reason"] = "abandonment"
             g["white_disconnect_timer"] = None
-        elif color == "black" and g.get("black_disconnect_timer"):
+        elif color == "black" and g.get("black_disconnect_timer") == timer:
             g["winner"] = "white"
             g["reason"] = "abandonment"
             g["black_disconnect_timer"] = None
         else:
             return 
-        save_game(room, g)
-        for sid in g.get("clients", set()):
-            socketio.emit("game_update", {"state": export_state(room, sid)}, room=sid)
+        broadcast_state(room)
+    # Persist after the result is out; the DB write doesn't hold the game lock
+    socketio.start_background_task(save_game, room, g)
 
 def cancel_timer(g, color):
-    if color == "white" and g.get("white_disconnect_timer"):
-        g["white_disconnect_timer"].cancel()
+    # The pending countdown sees its timer was replaced and does nothing
+    if color == "white":
         g["white_disconnect_timer"] = None
-    elif color == "black" and g.get("black_disconnect_timer"):
-        g["black_disconnect_timer"].cancel()
+    elif color == "black":
         g["black_disconnect_timer"] = None
 
 @socketio.on("create_room")
@@ -999,7 +1302,7 @@ def create(data):
     bot_difficulty = data.get("difficulty", "medium")  # Get difficulty from client
     client_user_id = data.get("user_id")  # User ID passed directly from client
 
-    creator_color = random.choice(["white", "black"]) if not is_bot else "white"
+    creator_color = ("white" if random.getrandbits(1) else "black") if not is_bot else "white"
 
     if room in games:
         g = games[room]
@@ -1021,36 +1324,25 @@ def create(data):
         if db_user:
             sid_to_user[request.sid] = {'id': db_user['id'], 'username': db_user['username']}
             user = sid_to_user[request.sid]
-            print(f"✅ Cached user from client-provided user_id in create_room: {user}")
+            log.info("✅ Cached user from client-provided user_id in create_room: %s", user)
 
     white_user_id = user['id'] if user and creator_color == "white" else None
     black_user_id = user['id'] if user and creator_color == "black" else None
-    print(f"🎮 Creating room {room} - user: {user['username'] if user else 'guest'}, white_user_id: {white_user_id}, black_user_id: {black_user_id}")
-
-    games[room] = {
-        "board": chess.Board(),
-        "whiteTime": float(data.get("timeControl", 300)),
-        "blackTime": float(data.get("timeControl", 300)),
-        "lastUpdate": time.time(),
-        "start_timestamp": datetime.utcnow(),
-        "isActive": True if is_bot else False,
-        "winner": None,
-        "bot": is_bot,
-        "bot_difficulty": bot_difficulty,  # Store difficulty level
-        "lock": threading.Lock(),
-        "white_player": white_player,
-        "black_player": black_player,
-        "white_sid": request.sid if creator_color == "white" else None,
-        "black_sid": request.sid if creator_color == "black" else None,
-        "white_user_id": white_user_id,
-        "black_user_id": black_user_id,
-        "white_disconnect_timer": None,
-        "black_disconnect_timer": None,
-        "clients": {request.sid},
-        "game_mode": "bot" if is_bot else "friend",
-        "move_history": []
-    }
+    log.info("🎮 Creating room %s - user: %s, white_user_id: %s, black_user_id: %s", room, user['username'] if user else 'guest', white_user_id, black_user_id)
+
+    games[room] = new_game(
+        white_player, black_player,
+        request.sid if creator_color == "white" else None,
+        request.sid if creator_color == "black" else None,
+        data.get("timeControl", 300),
+        "bot" if is_bot else "friend",
+        white_user_id=white_user_id,
+        black_user_id=black_user_id,
+        bot_difficulty=bot_difficulty,
+        is_active=is_bot
+    )
     
+    schedule_clock_expiry(room, games[room])
     sid_to_room[request.sid] = room
     join_room(room)
     emit("room_created", {
@@ -1066,7 +1358,8 @@ def join(data):
     spectate = data.get("spectate", False)  # NEW: Check if joining as spectator
     client_user_id = data.get("user_id")  # User ID passed directly from client
 
-    if room not in games:
+    g = games.get(room)
+    if g is None:
         emit("error", {"message": "Room not found"})
         return
 
@@ -1075,9 +1368,7 @@ def join(data):
         db_user = get_user_by_id(client_user_id)
         if db_user:
             sid_to_user[request.sid] = {'id': db_user['id'], 'username': db_user['username']}
-            print(f"✅ Cached user from client-provided user_id in join_room: {sid_to_user[request.sid]}")
-
-    g = games[room]
+            log.info("✅ Cached user from client-provided user_id in join_room: %s", sid_to_user[request.sid])
 
     reconnected = False
 
@@ -1100,7 +1391,7 @@ def join(data):
         user = get_socketio_user()
         if user:
             g["white_user_id"] = user['id']
-            print(f"🔗 Linked white player to user_id: {user['id']} ({user['username']})")
+            log.info("🔗 Linked white player to user_id: %s (%s)", user['id'], user['username'])
         # Check if both players are now connected (for global matchmaking)
         if g.get("black_sid") is not None:
             g["isActive"] = True
@@ -1115,7 +1406,7 @@ def join(data):
         user = get_socketio_user()
         if user:
             g["black_user_id"] = user['id']
-            print(f"🔗 Linked black player to user_id: {user['id']} ({user['username']})")
+            log.info("🔗 Linked black player to user_id: %s (%s)", user['id'], user['username'])
         # Check if both players are now connected (for global matchmaking)
         if g.get("white_sid") is not None:
             g["isActive"] = True
@@ -1125,27 +1416,22 @@ def join(data):
     # NEW: Handle spectator mode
     elif spectate or (g["white_player"] and g["black_player"]):
         # Join as spectator
-        if "spectators" not in g:
-            g["spectators"] = set()
-        g["spectators"].add(request.sid)
-        
-        if "clients" not in g: g["clients"] = set()
-        g["clients"].add(request.sid)
+        g["clients"][request.sid] = "spectator"
         sid_to_room[request.sid] = room
         join_room(room)
         
         # Notify other players about new spectator
-        spectator_count = len(g.get("spectators", set()))
+        spectators = spectator_count(g)
         socketio.emit("spectator_joined", {
             "spectatorName": player_name,
-            "spectatorCount": spectator_count
+            "spectatorCount": spectators
         }, room=room, skip_sid=request.sid)
         
         emit("room_joined", {
             "color": "spectator", 
             "state": export_state(room, request.sid), 
             "room": room,
-            "spectatorCount": spectator_count
+            "spectatorCount": spectators
         })
         return
 
@@ -1158,7 +1444,7 @@ def join(data):
         user = get_socketio_user()
         if user:
             g["white_user_id"] = user['id']
-            print(f"🔗 Linked white player to user_id: {user['id']} ({user['username']})")
+            log.info("🔗 Linked white player to user_id: %s (%s)", user['id'], user['username'])
     elif not g["black_player"]:
         g["black_player"] = player_name
         g["black_sid"] = request.sid
@@ -1168,31 +1454,32 @@ def join(data):
         user = get_socketio_user()
         if user:
             g["black_user_id"] = user['id']
-            print(f"🔗 Linked black player to user_id: {user['id']} ({user['username']})")
+            log.info("🔗 Linked black player to user_id: %s (%s)", user['id'], user['username'])
     else:
         if not reconnected:
             emit("error", {"message": "Room is full"})
             return
 
-    if "clients" not in g: g["clients"] = set()
-    g["clients"].add(request.sid)
+    if request.sid == g.get("white_sid"):
+        my_color = "white"
+    elif request.sid == g.get("black_sid"):
+        my_color = "black"
+    else:
+        my_color = "spectator"
+    g["clients"][request.sid] = my_color
     sid_to_room[request.sid] = room
     join_room(room)
-    
-    my_color = "white" if request.sid == g.get("white_sid") else "black"
-    if request.sid != g.get("white_sid") and request.sid != g.get("black_sid"):
-        my_color = "spectator"
+    schedule_clock_expiry(room, g)
 
-    spectator_count = len(g.get("spectators", set()))
+    spectators = spectator_count(g)
     emit("room_joined", {
         "color": my_color, 
         "state": export_state(room, request.sid), 
         "room": room,
-        "spectatorCount": spectator_count
+        "spectatorCount": spectators
     })
     
-    for sid in g.get("clients", set()):
-        socketio.emit("game_start", {"state": export_state(room, sid)}, room=sid)
+    broadcast_state(room, "game_start")
 
 # ===== GLOBAL MATCHMAKING =====
 @socketio.on("join_matchmaking")
@@ -1210,113 +1497,89 @@ def join_matchmaking(data):
         if db_user:
             sid_to_user[sid] = {'id': db_user['id'], 'username': db_user['username']}
             user = sid_to_user[sid]
-            print(f"✅ Cached user from client-provided user_id: {user}")
+            log.info("✅ Cached user from client-provided user_id: %s", user)
 
     with matchmaking_lock:
         # Check if already in queue
-        if any(p["sid"] == sid for p in matchmaking_queue):
+        if sid in matchmaking_waiting:
             emit("matchmaking_status", {"status": "already_in_queue"})
             return
         
         # Look for a match with same time control
-        match_found = None
-        for i, player in enumerate(matchmaking_queue):
-            if player["timeControl"] == time_control and player["sid"] != sid:
-                match_found = player
-                matchmaking_queue.pop(i)
-                break
-        
-        if match_found:
-            # Create game room
-            room = f"global-{secrets.token_hex(4)}"
-            
-            # Random color assignment
-            if random.choice([True, False]):
-                white_player = player_name
-                white_sid = sid
-                black_player = match_found["playerName"]
-                black_sid = match_found["sid"]
-            else:
-                white_player = match_found["playerName"]
-                white_sid = match_found["sid"]
-                black_player = player_name
-                black_sid = sid
-            
-            # Get user IDs if authenticated (check both possible players)
-            user = get_current_user()
-            # We can't determine user_ids yet since players will connect with new sids
-            # Set them to None and let join_room handle user linking
-            
-            games[room] = {
-                "board": chess.Board(),
-                "whiteTime": float(time_control),
-                "blackTime": float(time_control),
-                "lastUpdate": time.time(),
-                "start_timestamp": datetime.utcnow(),
-                "isActive": False,  # Will become True when both players join
-                "winner": None,
-                "bot": False,
-                "lock": threading.Lock(),
-                "white_player": white_player,
-                "black_player": black_player,
-                "white_sid": None,  # Will be set when player joins
-                "black_sid": None,  # Will be set when player joins
-                "white_user_id": None,  # Will be set when player joins
-                "black_user_id": None,  # Will be set when player joins
-                "white_disconnect_timer": None,
-                "black_disconnect_timer": None,
-                "clients": set(),
-                "game_mode": "global",
-                "move_history": []
-            }
-            
-            # Don't add to sid_to_room yet - will be done in join_room
-            
-            # Notify both players with their assigned names
-            socketio.emit("matchmaking_found", {
-                "room": room,
-                "playerName": white_player,
-                "color": "white"
-            }, room=white_sid)
-            
-            socketio.emit("matchmaking_found", {
-                "room": room,
-                "playerName": black_player,
-                "color": "black"
-            }, room=black_sid)
-            
-            print(f"✅ Match found! Room: {room}, White: {white_player}, Black: {black_player}")
-        else:
-            # Add to queue
-            matchmaking_queue.append({
+        match_found = pop_matchmaking_peer(time_control)
+        if match_found is None:
+            player = {
                 "sid": sid,
                 "playerName": player_name,
                 "timeControl": time_control,
                 "timestamp": time.time()
-            })
-            emit("matchmaking_status", {"status": "searching"})
-            print(f"🔍 Player {player_name} joined matchmaking queue (time: {time_control}s)")
+            }
+            matchmaking_waiting[sid] = player
+            matchmaking_queues.setdefault(time_control, OrderedDict())[sid] = player
+
+    if match_found:
+        # Create game room
+        room = f"global-{secrets.token_hex(4)}"
+        
+        # Random color assignment
+        if random.getrandbits(1):
+            white_player = player_name
+            white_sid = sid
+            black_player = match_found["playerName"]
+            black_sid = match_found["sid"]
+        else:
+            white_player = match_found["playerName"]
+            white_sid = match_found["sid"]
+            black_player = player_name
+            black_sid = sid
+        
+        # Get user IDs if authenticated (check both possible players)
+        user = get_current_user()
+        # We can't determine user_ids yet since players will connect with new sids
+        # Set them to None and let join_room handle user linking
+        
+        # Sids and user IDs are set when the players join the room
+        games[room] = new_game(white_player, black_player, None, None,
+                               time_control, "global", is_active=False)
+        
+        # Don't add to sid_to_room yet - will be done in join_room
+        
+        # Notify both players with their assigned names
+        socketio.emit("matchmaking_found", {
+            "room": room,
+            "playerName": white_player,
+            "color": "white"
+        }, room=white_sid)
+        
+        socketio.emit("matchmaking_found", {
+            "room": room,
+            "playerName": black_player,
+            "color": "black"
+        }, room=black_sid)
+        
+        log.info("✅ Match found! Room: %s, White: %s, Black: %s", room, white_player, black_player)
+    else:
+        emit("matchmaking_status", {"status": "searching"})
+        log.info("🔍 Player %s joined matchmaking queue (time: %ss)", player_name, time_control)
 
 @socketio.on("cancel_matchmaking")
 def cancel_matchmaking():
     sid = request.sid
     with matchmaking_lock:
-        for i, player in enumerate(matchmaking_queue):
-            if player["sid"] == sid:
-                matchmaking_queue.pop(i)
-                emit("matchmaking_cancelled")
-                print(f"❌ Player cancelled matchmaking")
-                return
+        player = remove_from_matchmaking(sid)
+    if player:
+        emit("matchmaking_cancelled")
+        log.info("❌ Player cancelled matchmaking")
 
 # ===== REMATCH FUNCTIONALITY =====
 @socketio.on("request_rematch")
 def request_rematch(data):
     room = data.get("room")
-    if room not in games:
+    g = games.get(room)
+    if g is None:
         emit("error", {"message": "Game not found"})
         return
-    
-    g = games[room]
+
     requester_sid = request.sid
     
     # Determine who is requesting
@@ -1340,50 +1603,35 @@ def request_rematch(data):
         # Get user ID if authenticated - use get_socketio_user for SocketIO context
         user = get_socketio_user()
         white_user_id = user['id'] if user else None
-        print(f"🔄 Bot rematch - user: {user['username'] if user else 'guest'}, white_user_id: {white_user_id}")
+        log.info("🔄 Bot rematch - user: %s, white_user_id: %s", user['username'] if user else 'guest', white_user_id)
 
         # Create new bot game
-        games[new_room] = {
-            "board": chess.Board(),
-            "whiteTime": float(time_control),
-            "blackTime": float(time_control),
-            "lastUpdate": time.time(),
-            "start_timestamp": datetime.utcnow(),
-            "isActive": True,
-            "winner": None,
-            "bot": True,
-            "bot_difficulty": bot_difficulty,  # Preserve difficulty
-            "lock": threading.Lock(),
-            "white_player": player_name,
-            "black_player": f"Bot ({bot_difficulty.capitalize()})",
-            "white_sid": requester_sid,
-            "black_sid": None,
-            "white_user_id": white_user_id,
-            "black_user_id": None,  # Bot has no user ID
-            "white_disconnect_timer": None,
-            "black_disconnect_timer": None,
-            "clients": {requester_sid},
-            "game_mode": "bot",
-            "move_history": []
-        }
+        games[new_room] = new_game(
+            player_name, f"Bot ({bot_difficulty.capitalize()})",
+            requester_sid, None, time_control, "bot",
+            white_user_id=white_user_id,
+            bot_difficulty=bot_difficulty
+        )
         
         sid_to_room[requester_sid] = new_room
+        leave_room(room)
+        join_room(new_room)
+        schedule_clock_expiry(new_room, games[new_room])
         
         emit("rematch_started", {
             "room": new_room,
             "color": "white",
             "state": export_state(new_room, requester_sid)
         })
-        print(f"🔄 Bot rematch created: {new_room}")
+        log.info("🔄 Bot rematch created: %s", new_room)
     else:
         # For multiplayer, need opponent acceptance
-        if "rematch_requests" not in g:
-            g["rematch_requests"] = set()
+        rematch_requests = g.setdefault("rematch_requests", set())
+        rematch_requests.add(requester_color)
         
-        g["rematch_requests"].add(requester_color)
-        
-        # Check if both players requested rematch
-        if len(g["rematch_requests"]) == 2:
+        # Check if both players requested rematch. Popping the set claims the
+        # rematch, so a repeated request can never create a second game.
+        if len(rematch_requests) == 2 and g.pop("rematch_requests", None) is rematch_requests:
             # Create new game
             new_room = f"{g.get('game_mode', 'friend')}-{secrets.token_hex(4)}"
             time_control = g.get("whiteTime", 300) if g.get("whiteTime", 300) > 0 else 300
@@ -1396,31 +1644,19 @@ def request_rematch(data):
             white_user_id = g.get("white_user_id")
             black_user_id = g.get("black_user_id")
 
-            games[new_room] = {
-                "board": chess.Board(),
-                "whiteTime": float(time_control),
-                "blackTime": float(time_control),
-                "lastUpdate": time.time(),
-                "start_timestamp": datetime.utcnow(),
-                "isActive": True,
-                "winner": None,
-                "bot": False,
-                "lock": threading.Lock(),
-                "white_player": white_player,
-                "black_player": black_player,
-                "white_sid": white_sid,
-                "black_sid": black_sid,
-                "white_user_id": white_user_id,
-                "black_user_id": black_user_id,
-                "white_disconnect_timer": None,
-                "black_disconnect_timer": None,
-                "clients": {white_sid, black_sid},
-                "game_mode": g.get("game_mode", "friend"),
-                "move_history": []
-            }
+            games[new_room] = new_game(
+                white_player, black_player, white_sid, black_sid,
+                time_control, g.get("game_mode", "friend"),
+                white_user_id=white_user_id,
+                black_user_id=black_user_id
+            )
             
             sid_to_room[white_sid] = new_room
             sid_to_room[black_sid] = new_room
+            for player_sid in (white_sid, black_sid):
+                leave_room(room, sid=player_sid)
+                join_room(new_room, sid=player_sid)
+            schedule_clock_expiry(new_room, games[new_room])
             
             # Notify both players
             socketio.emit("rematch_started", {
@@ -1435,7 +1671,7 @@ def request_rematch(data):
                 "state": export_state(new_room, black_sid)
             }, room=black_sid)
             
-            print(f"🔄 Rematch created: {new_room}")
+            log.info("🔄 Rematch created: %s", new_room)
         else:
             # Notify opponent of rematch request
             if opponent_sid:
@@ -1446,10 +1682,10 @@ def request_rematch(data):
 @socketio.on("decline_rematch")
 def decline_rematch(data):
     room = data.get("room")
-    if room not in games:
+    g = games.get(room)
+    if g is None:
         return
 
-    g = games[room]
     decliner_sid = request.sid
 
     # Determine who is declining
@@ -1471,7 +1707,7 @@ def decline_rematch(data):
         socketio.emit("rematch_declined", {
             "from": decliner_color
         }, room=opponent_sid)
-        print(f"❌ {decliner_color.upper()} declined rematch in room {room}")
+        log.info("❌ %s declined rematch in room %s", decliner_color.upper(), room)
 
 @socketio.on("disconnect")
 def on_disconnect():
@@ -1481,55 +1717,43 @@ def on_disconnect():
     # Clean up user mapping
     if sid in sid_to_user:
         user_info = sid_to_user.pop(sid)
-        print(f"🔌 SocketIO disconnected: {sid} -> user: {user_info.get('username', 'unknown')}")
+        log.info("🔌 SocketIO disconnected: %s -> user: %s", sid, user_info.get('username', 'unknown'))
     else:
-        print(f"🔌 SocketIO disconnected: {sid} -> guest")
+        log.info("🔌 SocketIO disconnected: %s -> guest", sid)
 
     # Remove from matchmaking queue
     with matchmaking_lock:
-        for i, player in enumerate(matchmaking_queue):
-            if player["sid"] == sid:
-                matchmaking_queue.pop(i)
-                break
+        remove_from_matchmaking(sid)
     
-    if room and room in games:
-        g = games[room]
-        
+    g = games.get(room) if room else None
+    if g is not None:
         disconnected_color = None
-        if sid == g.get("white_sid"):
-            disconnected_color = "white"
-        elif sid == g.get("black_sid"):
-            disconnected_color = "black"
-        elif sid in g.get("spectators", set()):
+        color = g["clients"].pop(sid, None)
+        if color in ("white", "black"):
+            # A player who already reconnected on a new sid is not disconnecting
+            if g.get(f"{color}_sid") == sid:
+                disconnected_color = color
+        elif color == "spectator":
             # Handle spectator disconnect
-            g["spectators"].discard(sid)
-            spectator_count = len(g.get("spectators", set()))
+            spectators = spectator_count(g)
             socketio.emit("spectator_left", {
-                "spectatorCount": spectator_count
+                "spectatorCount": spectators
             }, room=room)
 
-        if "clients" in g:
-            g["clients"].discard(sid)
-
         if disconnected_color and g.get("isActive") and not g["winner"]:
-            print(f"⚠️ {disconnected_color} disconnected from {room}. Starting {DISCONNECT_TIMEOUT}s timer.")
+            log.warning("⚠️ %s disconnected from %s. Starting %ss timer.", disconnected_color, room, DISCONNECT_TIMEOUT)
             socketio.emit("player_disconnected", {"color": disconnected_color, "timeout": DISCONNECT_TIMEOUT}, room=room)
-            t = threading.Timer(DISCONNECT_TIMEOUT, handle_disconnect_timeout, [room, disconnected_color])
-            t.start()
-            if disconnected_color == "white":
-                g["white_disconnect_timer"] = t
-            else:
-                g["black_disconnect_timer"] = t
+            start_disconnect_timer(room, g, disconnected_color)
 
         if len(g["clients"]) == 0 and not g.get("white_disconnect_timer") and not g.get("black_disconnect_timer"):
-            print(f"🧹 Room '{room}' is empty and idle. Deleting game.")
+            log.info("🧹 Room '%s' is empty and idle. Deleting game.", room)
             del games[room]
 
 @socketio.on("move")
 def move(data):
     room = data["room"]
-    if room not in games: return
-    g = games[room]
+    g = games.get(room)
+    if g is None: return
     
     if not g.get("isActive"): 
         emit("error", {"message": "Waiting for opponent..."})
@@ -1542,14 +1766,17 @@ def move(data):
         board = g["board"]
         f = chess.square(data["from"]["col"], 7-data["from"]["row"])
         t = chess.square(data["to"]["col"], 7-data["to"]["row"])
-        mv = chess.Move(f, t, chess.QUEEN if data.get("promotion") else None)
-        
-        if mv not in board.legal_moves and not data.get("promotion"):
-            mv = chess.Move(f, t, chess.QUEEN)
+        if not (0 <= f < 64 and 0 <= t < 64): return
+        # A pawn reaching the last rank always promotes to a queen
+        promote = data.get("promotion") or (
+            board.piece_type_at(f) == chess.PAWN and chess.square_rank(t) in (0, 7))
+        mv = chess.Move(f, t, chess.QUEEN if promote else None)
 
-        if mv in board.legal_moves:
+        if board.is_legal(mv):
             san = board.san(mv)
+            before = board.piece_map()
             board.push(mv)
+            g["zobrist"] = chess.polyglot.zobrist_hash(board)
             
             # Record move for replay
             if "move_history" not in g:
@@ -1568,60 +1795,108 @@ def move(data):
             if winner:
                 g["winner"] = winner
                 g["reason"] = reason
-                save_game(room, g)
+                # Save off the hot path so the final position goes out first
+                socketio.start_background_task(save_game, room, g)
+            else:
+                schedule_clock_expiry(room, g)
             
-            for sid in g.get("clients", set()):
-                socketio.emit("game_update", {
-                    "state": export_state(room, sid),
-                    "lastMove": data,
-                    "moveNotation": san
-                }, room=sid)
+            # Clients in the room hold the previous state; send only what changed
+            socketio.emit("game_update_delta", {
+                "delta": export_delta(room, before),
+                "lastMove": data,
+                "moveNotation": san
+            }, room=room)
 
             if g["bot"] and not g["winner"]: 
                 socketio.start_background_task(bot_play, room)
 
+def bot_limit(bot_difficulty):
+    """Stockfish search limit for a bot difficulty (easy, medium, hard)"""
+    if bot_difficulty == "easy":
+        # Limit depth and time for weaker play
+        return chess.engine.Limit(depth=1, time=0.1)
+    if bot_difficulty == "hard":
+        # Strong play with deeper search
+        return chess.engine.Limit(depth=15, time=1.0)
+    # medium (default): balanced play
+    return chess.engine.Limit(depth=8, time=0.5)
+
+def engine_cache_key(g, limit):
+    """Engine cache key for the game's position and limit, or None to always search"""
+    # The Zobrist hash ignores how the position was reached. A repeated position
+    # is searched fresh so the engine, which sees the move history, can avoid
+    # replaying the same line into a repetition.
+    if g["board"].is_repetition(2):
+        return None
+    return (position_key(g), limit.depth, int(limit.time * 1000))
+
 def bot_play(room):
-    time.sleep(0.5)
-    if room not in games: return
-    g = games[room]
+    socketio.sleep(0.5)
+    g = games.get(room)
+    if g is None: return
+
+    bot_difficulty = g.get("bot_difficulty", "medium")  # easy, medium, hard
+    if STOCKFISH_PATH:
+        limit = bot_limit(bot_difficulty)
+
+        # Transposition table: reuse a previous search of this exact position
+        # with this limit, so each difficulty keeps its own strength. Looked up
+        # before taking the game lock so the query doesn't hold up the room.
+        with g["lock"]:
+            if g["winner"]: return
+            cache_key = engine_cache_key(g, limit)
+        cached_move = get_cached_engine_move(*cache_key) if cache_key else None
 
     with g["lock"]:
         board = g["board"]
-        if board.is_game_over(): return
+        # check_game_over already ran after the player's move
+        if g["winner"]: return
 
         best_move = None
-        bot_difficulty = g.get("bot_difficulty", "medium")  # easy, medium, hard
 
         if STOCKFISH_PATH:
+            # The position may have moved on while the lock was free
+            key = engine_cache_key(g, limit)
+            if key != cache_key:
+                cache_key, cached_move = key, None
+            if cached_move:
+                best_move = chess.Move.from_uci(cached_move)
+                if board.is_legal(best_move):
+                    log.info("📚 Cached Stockfish move: %s (difficulty: %s)", best_move, bot_difficulty)
+                else:
+                    best_move = None
+
+        if STOCKFISH_PATH and not best_move:
             try:
-                engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
-
-                # Configure difficulty based on level
-                if bot_difficulty == "easy":
-                    # Limit depth and time for weaker play
-                    result = engine.play(board, chess.engine.Limit(depth=1, time=0.1))
-                elif bot_difficulty == "hard":
-                    # Strong play with deeper search
-                    result = engine.play(board, chess.engine.Limit(depth=15, time=1.0))
-                else:  # medium (default)
-                    # Balanced play
-                    result = engine.play(board, chess.engine.Limit(depth=8, time=0.5))
-
+                engine = acquire_engine()
+                try:
+                    # game=room sends ucinewgame whenever the engine switches games
+                    result = engine.play(board, limit, info=chess.engine.INFO_SCORE, game=room)
+                except Exception:
+                    release_engine(engine, broken=True)
+                    raise
+                release_engine(engine)
                 best_move = result.move
-                engine.quit()
-                print(f"🤖 Stockfish move: {best_move} (difficulty: {bot_difficulty})")
+                log.info("🤖 Stockfish move: %s (difficulty: %s)", best_move, bot_difficulty)
+
+                if cache_key:
+                    score = result.info.get("score")
+                    queue_engine_move(*cache_key, best_move.uci(),
+                                      score.white().score(mate_score=100000) if score else None)
             except Exception as e:
-                print(f"❌ Stockfish Error: {e}")
-                print(f"   Falling back to random moves")
-                best_move = random.choice(list(board.legal_moves))
-        else:
+                log.error("❌ Stockfish Error: %s", e)
+                log.info("   Falling back to random moves")
+                best_move = random_legal_move(board)
+        elif not STOCKFISH_PATH:
             # Fallback to random moves if Stockfish not available
-            print(f"🎲 Random bot move (Stockfish not available)")
-            best_move = random.choice(list(board.legal_moves))
+            log.info("🎲 Random bot move (Stockfish not available)")
+            best_move = random_legal_move(board)
 
         if best_move:
             san = board.san(best_move)
+            before = board.piece_map()
             board.push(best_move)
+            g["zobrist"] = chess.polyglot.zobrist_hash(board)
 
             # Record bot move for replay (same as player moves)
             if "move_history" not in g:
@@ -1640,15 +1915,56 @@ def bot_play(room):
             if winner:
                 g["winner"] = winner
                 g["reason"] = reason
-                save_game(room, g)
+                # Save off the hot path so the final position goes out first
+                socketio.start_background_task(save_game, room, g)
+            else:
+                schedule_clock_expiry(room, g)
 
-            for sid in g.get("clients", set()):
-                socketio.emit("game_update", {
-                    "state": export_state(room, sid),
-                    "lastMove": {"from": {"row": 7-chess.square_rank(best_move.from_square), "col": chess.square_file(best_move.from_square)},
-                                 "to": {"row": 7-chess.square_rank(best_move.to_square), "col": chess.square_file(best_move.to_square)}},
-                    "moveNotation": san
-                }, room=sid)
+            socketio.emit("game_update_delta", {
+                "delta": export_delta(room, before),
+                "lastMove": {"from": {"row": 7-chess.square_rank(best_move.from_square), "col": chess.square_file(best_move.from_square)},
+                             "to": {"row": 7-chess.square_rank(best_move.to_square), "col": chess.square_file(best_move.to_square)}},
+                "moveNotation": san
+            }, room=room)
+
+@socketio.on("sync_state")
+def sync_state(data):
+    """Full state for a client whose copy fell out of step with the deltas"""
+    room = data.get("room")
+    if room in games and request.sid in games[room]["clients"]:
+        emit("game_update", {"state": export_state(room, request.sid)})
+
+# ===== OUTBOUND EVENT BATCHING =====
+# Chat and typing events for a room are held for BATCH_WINDOW seconds and
+# sent as one "batch" message; the client dispatches each entry in order.
+# game_update/game_update_delta are not batched: holding a move back would add
+# the batch window to every move's latency, and a move is a single event
+# rather than a flood.
+BATCH_WINDOW = 0.02
+BATCH_MAX_EVENTS = 128
+pending_events = {}  # room -> [{"event": ..., "data": ...}]
+pending_events_lock = threading.Lock()
+
+def queue_room_event(room, event, data):
+    """Queue an event for the room's next batch"""
+    full = None
+    with pending_events_lock:
+        batch = pending_events.get(room)
+        if batch is None:
+            batch = pending_events[room] = []
+            socketio.start_background_task(flush_room_events, room)
+        batch.append({"event": event, "data": data})
+        if len(batch) >= BATCH_MAX_EVENTS:
+            full = pending_events.pop(room)
+    if full:
+        socketio.emit("batch", full, room=room)
+
+def flush_room_events(room):
+    socketio.sleep(BATCH_WINDOW)
+    with pending_events_lock:
+        batch = pending_events.pop(room, None)
+    if batch:
+        socketio.emit("batch", batch, room=room)
 
 @socketio.on("send_message")
 def msg(data):
@@ -1660,26 +1976,26 @@ def msg(data):
         return
 
     # Check if sender is actually a player in the game
-    if room in games:
-        g = games[room]
-        if request.sid not in [g.get("white_sid"), g.get("black_sid")]:
-            return
+    g = games.get(room)
+    if g is not None and request.sid not in (g.get("white_sid"), g.get("black_sid")):
+        return
 
-    socketio.emit("chat_message", data, room=room)
+    queue_room_event(room, "chat_message", data)
 
 @socketio.on("typing")
 def on_typing(data):
     # Block spectators from showing typing indicator
     if data.get("sender") == "spectator":
         return
-    socketio.emit("user_typing", data, room=data["room"], skip_sid=request.sid)
+    # The sender's own copy is ignored client-side (matched by color)
+    queue_room_event(data["room"], "user_typing", data)
 
 @socketio.on("stop_typing")
 def on_stop_typing(data):
     # Block spectators from showing typing indicator
     if data.get("sender") == "spectator":
         return
-    socketio.emit("user_stop_typing", data, room=data["room"], skip_sid=request.sid)
+    queue_room_event(data["room"], "user_stop_typing", data)
 
 @socketio.on("offer_draw")
 def offer_draw(data):
@@ -1688,28 +2004,26 @@ def offer_draw(data):
 @socketio.on("respond_draw")
 def respond_draw(data):
     room = data["room"]
-    if room not in games: return
-    g = games[room]
+    g = games.get(room)
+    if g is None: return
     if data["accept"]:
         g["winner"] = "draw"
         g["reason"] = "agreement"
-        save_game(room, g)
-        for sid in g.get("clients", set()):
-            socketio.emit("game_update", {"state": export_state(room, sid)}, room=sid)
+        broadcast_state(room)
+        socketio.start_background_task(save_game, room, g)
     else:
         socketio.emit("draw_declined", {}, room=room)
 
 @socketio.on("resign")
 def resign(data):
     room = data["room"]
-    if room not in games: return
-    g = games[room]
+    g = games.get(room)
+    if g is None: return
     if g["winner"]: return
     g["winner"] = "black" if data["color"] == "white" else "white"
     g["reason"] = "resign"
-    save_game(room, g)
-    for sid in g.get("clients", set()):
-        socketio.emit("game_update", {"state": export_state(room, sid)}, room=sid)
+    broadcast_state(room)
+    socketio.start_background_task(save_game, room, g)
 
 @socketio.on("leave_room")
 def on_leave(data):
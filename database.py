@@ -4,1158 +4,1603 @@ Supports PostgreSQL (Railway/Production) and SQLite (Local Development)
 """
 
 import os
+import atexit
+import functools
+from contextlib import contextmanager
 from datetime import datetime
 import threading
-import traceback
+import time
+import logging
+import queue
+from collections import OrderedDict
+from pathlib import Path
+from operator import itemgetter
+
+# Child of the app's "chess" logger, so records go through its queue handler.
+# Error lines are always emitted; tracebacks only when DEBUG is enabled.
+log = logging.getLogger("chess.db")
 
 # Check if PostgreSQL is available (Railway sets DATABASE_URL)
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
 if DATABASE_URL:
-    # Use PostgreSQL with connection pool
-    import psycopg2
-    from psycopg2.extras import RealDictCursor
-    from psycopg2 import pool
+    # Use PostgreSQL (psycopg 3) with its native connection pool
+    import psycopg
+    from psycopg.rows import dict_row
+    from psycopg_pool import ConnectionPool
     USE_POSTGRES = True
-    print("🐘 Using PostgreSQL database")
+    log.info("🐘 Using PostgreSQL database")
+
+    # Connections idle longer than this may have been dropped by the proxy,
+    # so they get pinged before being handed out
+    PING_IDLE_AFTER = 30.0
+
+    def _stamp_connection(conn):
+        """Pool configure hook: a brand-new connection counts as just used"""
+        conn._idle_since = time.monotonic()
+
+    def _ping_if_idle(conn):
+        """Pool check hook: probe only connections that sat idle a while"""
+        if time.monotonic() - getattr(conn, "_idle_since", 0) > PING_IDLE_AFTER:
+            # An empty query in autocommit is a single round-trip: no BEGIN,
+            # nothing to parse or plan, nothing to roll back
+            conn.autocommit = True
+            try:
+                conn.execute("")
+            finally:
+                conn.autocommit = False
 
     # Create a connection pool for PostgreSQL
     try:
-        # Use ThreadedConnectionPool for thread-safe connections
-        db_pool = pool.ThreadedConnectionPool(
-            minconn=1,
-            maxconn=10,
-            dsn=DATABASE_URL,
-            sslmode="require"
+        # prepare_threshold makes psycopg prepare a statement server-side once it
+        # has run 5 times on a connection, so hot lookups skip parse/plan.
+        # Recently used connections skip the ping; a dead one is caught on the
+        # failing query instead (see retry_on_db_error).
+        # A checkout waits at most 10s for a free connection; connections idle
+        # for 5 minutes are closed down to min_size, and every connection is
+        # recycled after 30 minutes.
+        db_pool = ConnectionPool(
+            DATABASE_URL,
+            min_size=2,
+            max_size=16,
+            timeout=10,
+            max_idle=300,
+            max_lifetime=1800,
+            configure=_stamp_connection,
+            check=_ping_if_idle,
+            kwargs={
+                "sslmode": "require", "prepare_threshold": 5, "row_factory": dict_row,
+                # TCP keepalives stop NAT/proxy idle timers from silently dropping
+                # pooled connections between bursts of traffic
+                "keepalives": 1, "keepalives_idle": 30,
+                "keepalives_interval": 10, "keepalives_count": 3,
+            },
+            open=True
         )
-        print("✅ PostgreSQL connection pool created")
+        log.info("✅ PostgreSQL connection pool created")
     except Exception as e:
-        print(f"❌ Failed to create PostgreSQL connection pool: {e}")
-        traceback.print_exc()
+        log.error("❌ Failed to create PostgreSQL connection pool: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         db_pool = None
 else:
     # Use SQLite for local development
     import sqlite3
     USE_POSTGRES = False
     db_pool = None
-    print("📦 Using SQLite database for local development")
+    log.info("📦 Using SQLite database for local development")
+
+# Extra execute() arguments for the hot user lookups: psycopg prepares these
+# on their first run instead of waiting for prepare_threshold. sqlite3 caches
+# compiled statements per connection on its own.
+PREPARE_NOW = {"prepare": True} if USE_POSTGRES else {}
 
-# Thread-local storage for SQLite connections
+# Parameter placeholder for the active backend; the SQL_* query constants
+# below are built with it once at import time
+PH = '%s' if USE_POSTGRES else '?'
+# Current UTC time as a naive timestamp, matching how expiry times are stored
+NOW_UTC = "(CURRENT_TIMESTAMP AT TIME ZONE 'UTC')" if USE_POSTGRES else "CURRENT_TIMESTAMP"
+
+# Per-thread flags for the PostgreSQL retry logic
 thread_local = threading.local()
 
 # SQLite database path (only used when PostgreSQL is not available)
 DB_PATH = os.path.join(os.path.dirname(__file__), 'chess_master.db')
 
-def get_db_conn():
-    """Get a database connection from pool (PostgreSQL) or thread-local (SQLite)"""
-    if USE_POSTGRES:
-        if db_pool is None:
-            raise Exception("PostgreSQL connection pool not initialized")
+# SQLite connections are pooled like PostgreSQL's: eventlet makes
+# threading.local per-greenlet, so per-thread connections would mean one per
+# request. Every checkout (nested db_cursor() calls included) gets a
+# connection to itself; a checkout waits at most SQLITE_POOL_TIMEOUT seconds.
+# Reads have their own pool of read-only connections, so they never wait on
+# a writer's lock.
+SQLITE_POOL_SIZE = 8
+SQLITE_POOL_TIMEOUT = 10
+
+class SqlitePool:
+    """Bounded pool of SQLite connections with psycopg_pool's getconn/putconn"""
+
+    def __init__(self, size, read_only=False):
+        self.read_only = read_only
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def getconn(self):
+        """Take an idle connection, opening a new one while under the size limit"""
+        if not self.slots.acquire(timeout=SQLITE_POOL_TIMEOUT):
+            raise Exception("Timed out waiting for a SQLite connection")
         try:
-            conn = db_pool.getconn()
-            if conn.closed:
-                print("⚠️ Got closed connection from pool, reconnecting...")
-                db_pool.putconn(conn, close=True)
-                conn = db_pool.getconn()
-            return conn
-        except Exception as e:
-            print(f"❌ Error getting connection from pool: {e}")
-            traceback.print_exc()
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return _open_sqlite_conn(self.read_only)
+        except Exception:
+            self.slots.release()
             raise
-    else:
-        # SQLite - use thread-local connection
-        if not hasattr(thread_local, 'connection') or thread_local.connection is None:
-            thread_local.connection = sqlite3.connect(DB_PATH, check_same_thread=False)
-            thread_local.connection.row_factory = sqlite3.Row
-        return thread_local.connection
 
-def release_db_conn(conn):
+    def putconn(self, conn):
+        """Return a connection to the pool"""
+        try:
+            # Don't hand the next caller a transaction someone else left open
+            if conn.in_transaction:
+                conn.rollback()
+        except Exception:
+            conn.close()
+        else:
+            self.idle.put(conn)
+        finally:
+            self.slots.release()
+
+def _get_pg_conn():
+    """Get a database connection from the PostgreSQL pool"""
+    if db_pool is None:
+        raise Exception("PostgreSQL connection pool not initialized")
+    try:
+        return db_pool.getconn()
+    except Exception as e:
+        log.error("❌ Error getting connection from pool: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
+        raise
+
+def _open_sqlite_conn(read_only=False):
+    """Open a SQLite connection, read-only (mode=ro) if asked"""
+    # Pooled connections move between threads, one user at a time
+    if read_only:
+        conn = sqlite3.connect(Path(DB_PATH).as_uri() + "?mode=ro", uri=True, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.row_factory = sqlite_dict_row
+    # journal_mode=WAL is stored in the database file and set once by
+    # init_db_pool; NORMAL sync is safe with WAL
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+def _release_pg_conn(conn):
     """Release database connection back to pool"""
-    if USE_POSTGRES and db_pool is not None and conn is not None:
+    if db_pool is not None and conn is not None:
         try:
+            # Close any transaction left open by a read so the pool doesn't warn
+            if conn.closed:
+                # Lost the server mid-query; the pool discards it on return
+                thread_local.conn_broken = True
+            elif conn.info.transaction_status == psycopg.pq.TransactionStatus.INTRANS:
+                conn.rollback()
+            conn._idle_since = time.monotonic()
             db_pool.putconn(conn)
         except Exception as e:
-            print(f"⚠️ Error returning connection to pool: {e}")
+            log.warning("⚠️ Error returning connection to pool: %s", e)
+
+# The backend is fixed at import time, so bind the right pair once instead of
+# branching on USE_POSTGRES around every query
+if USE_POSTGRES:
+    get_db_conn = _get_pg_conn
+    release_db_conn = _release_pg_conn
+    # One pool serves reads and writes
+    get_read_conn = get_db_conn
+    release_read_conn = release_db_conn
+else:
+    sqlite_pool = SqlitePool(SQLITE_POOL_SIZE)
+    get_db_conn = sqlite_pool.getconn
+    release_db_conn = sqlite_pool.putconn
+    sqlite_read_pool = SqlitePool(SQLITE_POOL_SIZE, read_only=True)
+    get_read_conn = sqlite_read_pool.getconn
+    release_read_conn = sqlite_read_pool.putconn
+
+@contextmanager
+def db_cursor(read_only=False):
+    """Yield a cursor; commit on success, roll back on error, always release"""
+    if read_only:
+        conn = get_read_conn()
+        release = release_read_conn
+    else:
+        conn = get_db_conn()
+        release = release_db_conn
+    try:
+        yield conn.cursor()
+        conn.commit()
+    except Exception:
+        # A connection that died mid-query can't roll back; the pool drops it
+        if not getattr(conn, "closed", False):
+            conn.rollback()
+        raise
+    finally:
+        release(conn)
+
+# SQLite: small fire-and-forget writes (visitor counts, login times, code
+# updates) go to one writer thread on its own connection, which commits
+# whatever has queued up in one transaction. PostgreSQL runs them inline.
+SQLITE_WRITE_BATCH_SIZE = 128
+sqlite_write_queue = queue.Queue()
+sqlite_writer = None
+sqlite_writer_lock = threading.Lock()
+
+def execute_write(sql, rows):
+    """Run sql once per parameter tuple in rows; on SQLite, queue it for the writer thread"""
+    global sqlite_writer
+    if USE_POSTGRES:
+        with db_cursor() as cur:
+            cur.executemany(sql, rows)
+        return
+    sqlite_write_queue.put((sql, rows))
+    with sqlite_writer_lock:
+        if sqlite_writer is None:
+            sqlite_writer = threading.Thread(target=_sqlite_writer_loop, daemon=True)
+            sqlite_writer.start()
+
+def _sqlite_writer_loop():
+    """Apply queued SQLite writes in batches until a None job asks it to stop"""
+    conn = None
+    while True:
+        jobs = [sqlite_write_queue.get()]
+        while len(jobs) < SQLITE_WRITE_BATCH_SIZE:
+            try:
+                jobs.append(sqlite_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        stop = None in jobs
+        jobs = [job for job in jobs if job is not None]
+        try:
+            if conn is None:
+                conn = _open_sqlite_conn()
+            with conn:
+                for sql, rows in jobs:
+                    conn.executemany(sql, rows)
+        except Exception:
+            # Redo them one transaction each, so one bad write doesn't drop the rest
+            for sql, rows in jobs:
+                try:
+                    if conn is None:
+                        conn = _open_sqlite_conn()
+                    with conn:
+                        conn.executemany(sql, rows)
+                except Exception as e:
+                    log.error("❌ Queued SQLite write failed: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
+        if stop:
+            return
+
+def stop_sqlite_writer(timeout=5.0):
+    """Let the SQLite writer finish what is queued, then stop it"""
+    if sqlite_writer is not None and sqlite_writer.is_alive():
+        sqlite_write_queue.put(None)
+        sqlite_writer.join(timeout)
+
+def sqlite_dict_row(cursor, row):
+    """SQLite row factory matching psycopg's dict_row: plain dicts, no copy needed"""
+    return dict(zip([col[0] for col in cursor.description], row))
+
+# Reads only: a write whose COMMIT reached the server just before the
+# connection dropped would be applied twice by the rerun
+def retry_on_db_error(func):
+    """Run a read query function once more on a fresh connection if its connection died"""
+    if not USE_POSTGRES:
+        # A local SQLite file connection doesn't drop out from under us
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        thread_local.conn_broken = False
+        result = func(*args, **kwargs)
+        if thread_local.conn_broken:
+            log.warning("🔁 Connection lost during %s, retrying", func.__name__)
+            thread_local.conn_broken = False
+            # Siblings in the pool likely died with it (e.g. a server restart)
+            db_pool.check()
+            result = func(*args, **kwargs)
+        return result
+    return wrapper
+
+# Advisory lock key for schema setup ("chess" in ASCII)
+SCHEMA_LOCK_ID = 0x6368657373
+
+@contextmanager
+def schema_lock():
+    """Let one worker at a time create and migrate the schema (PostgreSQL)"""
+    if not USE_POSTGRES:
+        yield
+        return
+    conn = get_db_conn()
+    try:
+        # Session-level lock held on its own idle connection, outside any
+        # transaction. Waiters poll rather than block in pg_advisory_lock: a
+        # waiting statement holds a snapshot, and CREATE INDEX CONCURRENTLY
+        # in the lock holder would wait on it forever.
+        conn.autocommit = True
+        while not conn.execute("SELECT pg_try_advisory_lock(%s) AS locked",
+                               (SCHEMA_LOCK_ID,)).fetchone()["locked"]:
+            time.sleep(0.2)
+        try:
+            yield
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_LOCK_ID,))
+    finally:
+        if not conn.closed:
+            conn.autocommit = False
+        release_db_conn(conn)
 
 def init_db_pool():
     """Initialize database and create tables"""
     if USE_POSTGRES:
-        print(f"🐘 Connected to PostgreSQL via connection pool")
+        log.info("🐘 Connected to PostgreSQL via connection pool")
     else:
-        print(f"📂 Database file: {DB_PATH}")
-
-    create_tables()
-
-    # Auto-migrate tables if needed (for existing databases)
-    if USE_POSTGRES:
-        migrate_games_table()
-        migrate_game_moves_table()
-
-    print("✅ Database initialized successfully")
-
-def migrate_games_table():
-    """Auto-migrate games table to add any missing columns"""
-    conn = get_db_conn()
+        log.info("📂 Database file: %s", DB_PATH)
+        # WAL lets readers run alongside the writer; it's a property of the
+        # database file, so one connection sets it for all of them
+        with db_cursor() as cur:
+            cur.execute("PRAGMA journal_mode=WAL").fetchone()
+
+    with schema_lock():
+        create_tables()
+
+        # Auto-migrate tables if needed (for existing databases)
+        # Only recorded once every migration succeeded, so a failed one is
+        # retried on the next start
+        if USE_POSTGRES and get_schema_version() < SCHEMA_VERSION:
+            migrated = [migrate_games_table(), migrate_game_moves_table(),
+                        backfill_game_end_times()]
+            if all(migrated):
+                set_schema_version(SCHEMA_VERSION)
+
+        # After migrations, so older tables already have the indexed columns
+        create_game_indexes()
+
+    log.info("✅ Database initialized successfully")
+
+# Bump when a migration is added so existing databases run it once
+SCHEMA_VERSION = 3
+
+def get_schema_version():
+    """Return the recorded schema version, 0 if none has been recorded"""
     try:
-        cur = conn.cursor()
+        with db_cursor() as cur:
+            cur.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+            cur.execute("SELECT MAX(version) AS version FROM schema_version")
+            row = cur.fetchone()
+        return row['version'] or 0
+    except Exception as e:
+        log.warning("⚠️ Could not read schema version: %s", e)
+        return 0
 
-        # Check if games table exists and has room_code column
-        cur.execute("""
-            SELECT column_name FROM information_schema.columns
-            WHERE table_name = 'games'
-        """)
-        existing_columns = {row[0] for row in cur.fetchall()}
+def set_schema_version(version):
+    """Record that migrations up to version have been applied"""
+    try:
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM schema_version")
+            cur.execute("INSERT INTO schema_version (version) VALUES (%s)", (version,))
+        log.info("✅ Schema version set to %s", version)
+    except Exception as e:
+        log.warning("⚠️ Could not record schema version: %s", e)
 
-        if not existing_columns:
-            print("📝 Games table doesn't exist yet, will be created")
-            return
+def add_columns_sql(table, columns):
+    """Build one idempotent ALTER TABLE adding every (name, type) column"""
+    return f"ALTER TABLE {table} " + ", ".join(
+        f"ADD COLUMN IF NOT EXISTS {name} {col_type}" for name, col_type in columns
+    )
 
-        # Columns that should exist
-        columns_to_add = [
-            ("room_code", "VARCHAR(100)"),
-            ("white_player", "VARCHAR(100)"),
-            ("black_player", "VARCHAR(100)"),
-            ("white_user_id", "INTEGER"),
-            ("black_user_id", "INTEGER"),
-            ("winner", "VARCHAR(20)"),
-            ("win_reason", "VARCHAR(50)"),
-            ("game_mode", "VARCHAR(20)"),
-            ("time_control", "INTEGER"),
-            ("start_time", "TIMESTAMP"),
-            ("end_time", "TIMESTAMP"),
-            ("move_count", "INTEGER DEFAULT 0"),
-            ("created_at", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"),
-        ]
-
-        added_columns = []
-        for col_name, col_type in columns_to_add:
-            if col_name not in existing_columns:
-                try:
-                    cur.execute(f"ALTER TABLE games ADD COLUMN {col_name} {col_type}")
-                    added_columns.append(col_name)
-                except Exception as e:
-                    print(f"⚠️ Could not add column {col_name}: {e}")
+def add_missing_columns(table, sql):
+    """Run a prebuilt add_columns_sql() statement for table; False if it failed"""
+    try:
+        with db_cursor() as cur:
+            cur.execute(sql)
+        log.info("✅ %s table schema is up to date", table)
+        return True
+    except Exception as e:
+        log.warning("⚠️ %s auto-migration failed: %s", table, e)
+        return False
 
-        if added_columns:
-            conn.commit()
-            print(f"✅ Auto-migrated games table, added columns: {', '.join(added_columns)}")
-        else:
-            print("✅ Games table schema is up to date")
+# Columns older games/game_moves tables may be missing (PostgreSQL types)
+GAMES_COLUMNS = (
+    ("room_code", "VARCHAR(100)"),
+    ("white_player", "VARCHAR(100)"),
+    ("black_player", "VARCHAR(100)"),
+    ("white_user_id", "INTEGER"),
+    ("black_user_id", "INTEGER"),
+    ("winner", "VARCHAR(20)"),
+    ("win_reason", "VARCHAR(50)"),
+    ("game_mode", "VARCHAR(20)"),
+    ("time_control", "INTEGER"),
+    ("start_time", "TIMESTAMP"),
+    ("end_time", "TIMESTAMP"),
+    ("move_count", "INTEGER DEFAULT 0"),
+    ("created_at", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"),
+)
+GAME_MOVES_COLUMNS = (
+    ("game_id", "INTEGER"),
+    ("move_number", "INTEGER"),
+    ("move_notation", "VARCHAR(20)"),
+    ("from_square", "VARCHAR(10)"),
+    ("to_square", "VARCHAR(10)"),
+    ("position_fen", "TEXT"),
+    ("white_time_remaining", "REAL"),
+    ("black_time_remaining", "REAL"),
+    ("created_at", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"),
+)
+SQL_MIGRATE_GAMES = add_columns_sql("games", GAMES_COLUMNS)
+SQL_MIGRATE_GAME_MOVES = add_columns_sql("game_moves", GAME_MOVES_COLUMNS)
 
-    except Exception as e:
-        print(f"⚠️ Auto-migration check failed: {e}")
-        conn.rollback()
-    finally:
-        release_db_conn(conn)
+def migrate_games_table():
+    """Auto-migrate games table to add any missing columns"""
+    return add_missing_columns("games", SQL_MIGRATE_GAMES)
 
 def migrate_game_moves_table():
     """Auto-migrate game_moves table to add any missing columns"""
-    conn = get_db_conn()
-    try:
-        cur = conn.cursor()
-
-        # Check if game_moves table exists
-        cur.execute("""
-            SELECT column_name FROM information_schema.columns
-            WHERE table_name = 'game_moves'
-        """)
-        existing_columns = {row[0] for row in cur.fetchall()}
+    return add_missing_columns("game_moves", SQL_MIGRATE_GAME_MOVES)
+
+# Games saved before the end_time column existed have none. History pages on
+# (end_time, id), and a NULL end_time compares as unknown (and sorts first on
+# PostgreSQL), so those games could never be paged past.
+SQL_BACKFILL_GAME_END_TIMES = """
+    UPDATE games SET end_time = COALESCE(start_time, created_at)
+    WHERE end_time IS NULL
+"""
 
-        if not existing_columns:
-            print("📝 game_moves table doesn't exist yet, will be created")
-            return
+def backfill_game_end_times():
+    """Give games without an end_time one, from their start or creation time"""
+    try:
+        with db_cursor() as cur:
+            cur.execute(SQL_BACKFILL_GAME_END_TIMES)
+        log.info("✅ games end_time backfilled")
+        return True
+    except Exception as e:
+        log.warning("⚠️ games end_time backfill failed: %s", e)
+        return False
 
-        # Columns that should exist
-        columns_to_add = [
-            ("game_id", "INTEGER"),
-            ("move_number", "INTEGER"),
-            ("move_notation", "VARCHAR(20)"),
-            ("from_square", "VARCHAR(10)"),
-            ("to_square", "VARCHAR(10)"),
-            ("position_fen", "TEXT"),
-            ("white_time_remaining", "REAL"),
-            ("black_time_remaining", "REAL"),
-            ("created_at", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"),
-        ]
-
-        added_columns = []
-        for col_name, col_type in columns_to_add:
-            if col_name not in existing_columns:
-                try:
-                    cur.execute(f"ALTER TABLE game_moves ADD COLUMN {col_name} {col_type}")
-                    added_columns.append(col_name)
-                except Exception as e:
-                    print(f"⚠️ Could not add column {col_name}: {e}")
+# CONCURRENTLY builds without blocking writes to a live games table; it can't
+# run inside a transaction, so PostgreSQL builds these in autocommit
+INDEX_BUILD = "CREATE INDEX CONCURRENTLY" if USE_POSTGRES else "CREATE INDEX"
+# Index name -> what it indexes
+GAME_INDEXES = {
+    "idx_games_white_user": "games (white_user_id, end_time DESC, id DESC)",
+    "idx_games_black_user": "games (black_user_id, end_time DESC, id DESC)",
+    "idx_game_moves_game": "game_moves (game_id, move_number)",
+}
+
+# A CONCURRENTLY build that fails or is killed leaves an INVALID index behind,
+# which IF NOT EXISTS would then skip on every start
+SQL_INVALID_INDEXES = """
+    SELECT c.relname AS name
+    FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE NOT i.indisvalid
+      AND i.indexrelid IN (SELECT to_regclass(name) FROM unnest(%s::text[]) AS name)
+"""
 
-        if added_columns:
-            conn.commit()
-            print(f"✅ Auto-migrated game_moves table, added columns: {', '.join(added_columns)}")
-        else:
-            print("✅ game_moves table schema is up to date")
+def build_game_indexes(cur, names):
+    """Create each named game index that doesn't exist yet"""
+    for name in names:
+        try:
+            cur.execute(f"{INDEX_BUILD} IF NOT EXISTS {name} ON {GAME_INDEXES[name]}")
+        except Exception as e:
+            log.warning("⚠️ Could not create game index %s: %s", name, e)
 
+def create_game_indexes():
+    """Index game history per player (newest first) and replay move lists"""
+    try:
+        with db_cursor() as cur:
+            if USE_POSTGRES:
+                cur.connection.autocommit = True
+            try:
+                build_game_indexes(cur, GAME_INDEXES)
+                if USE_POSTGRES:
+                    cur.execute(SQL_INVALID_INDEXES, (list(GAME_INDEXES),))
+                    invalid = [row['name'] for row in cur.fetchall()]
+                    for name in invalid:
+                        log.warning("⚠️ Rebuilding invalid index %s", name)
+                        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                    build_game_indexes(cur, invalid)
+            finally:
+                if USE_POSTGRES:
+                    cur.connection.autocommit = False
     except Exception as e:
-        print(f"⚠️ game_moves auto-migration check failed: {e}")
-        conn.rollback()
-    finally:
-        release_db_conn(conn)
+        log.warning("⚠️ Could not create game indexes: %s", e)
+
+# Schema for each backend, run as one script by create_tables
+DDL_POSTGRES = """
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    username VARCHAR(50) UNIQUE NOT NULL,
+    email VARCHAR(255) UNIQUE NOT NULL,
+    password_hash VARCHAR(255) NOT NULL,
+    display_name VARCHAR(100),
+    elo_rating INTEGER DEFAULT 1200,
+    games_played INTEGER DEFAULT 0,
+    games_won INTEGER DEFAULT 0,
+    games_drawn INTEGER DEFAULT 0,
+    games_lost INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_login TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS games (
+    id SERIAL PRIMARY KEY,
+    room_code VARCHAR(100) NOT NULL,
+    white_player VARCHAR(100),
+    black_player VARCHAR(100),
+    white_user_id INTEGER REFERENCES users(id),
+    black_user_id INTEGER REFERENCES users(id),
+    winner VARCHAR(20),
+    win_reason VARCHAR(50),
+    game_mode VARCHAR(20),
+    time_control INTEGER,
+    start_time TIMESTAMP,
+    end_time TIMESTAMP,
+    move_count INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS game_moves (
+    id SERIAL PRIMARY KEY,
+    game_id INTEGER NOT NULL REFERENCES games(id) ON DELETE CASCADE,
+    move_number INTEGER NOT NULL,
+    move_notation VARCHAR(20) NOT NULL,
+    from_square VARCHAR(10),
+    to_square VARCHAR(10),
+    position_fen TEXT,
+    white_time_remaining REAL,
+    black_time_remaining REAL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS visitor_count (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    count INTEGER DEFAULT 0
+);
+
+-- Insert initial visitor count if not exists
+INSERT INTO visitor_count (id, count) VALUES (1, 0)
+ON CONFLICT (id) DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS password_reset_codes (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    email VARCHAR(255) NOT NULL,
+    code VARCHAR(10) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL,
+    used INTEGER DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS email_verification_codes (
+    id SERIAL PRIMARY KEY,
+    email VARCHAR(255) NOT NULL,
+    username VARCHAR(50) NOT NULL,
+    password_hash VARCHAR(255) NOT NULL,
+    display_name VARCHAR(100),
+    code VARCHAR(10) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL,
+    verified INTEGER DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS engine_moves (
+    zobrist BIGINT NOT NULL,
+    depth INTEGER NOT NULL,
+    movetime_ms INTEGER NOT NULL,
+    best_move VARCHAR(10) NOT NULL,
+    score INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (zobrist, depth, movetime_ms)
+);
+
+-- Leaderboard: top ratings among players with at least one game
+CREATE INDEX IF NOT EXISTS idx_users_leaderboard
+ON users (elo_rating DESC) WHERE games_played > 0;
+
+-- Code lookups only ever look at codes that are still unused
+CREATE INDEX IF NOT EXISTS idx_reset_codes_lookup
+ON password_reset_codes (email, code) WHERE used = 0;
+
+CREATE INDEX IF NOT EXISTS idx_verification_codes_lookup
+ON email_verification_codes (email, code) WHERE verified = 0;
+"""
+
+DDL_SQLITE = """
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL,
+    email TEXT UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL,
+    display_name TEXT,
+    elo_rating INTEGER DEFAULT 1200,
+    games_played INTEGER DEFAULT 0,
+    games_won INTEGER DEFAULT 0,
+    games_drawn INTEGER DEFAULT 0,
+    games_lost INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_login TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    room_code TEXT NOT NULL,
+    white_player TEXT,
+    black_player TEXT,
+    white_user_id INTEGER,
+    black_user_id INTEGER,
+    winner TEXT,
+    win_reason TEXT,
+    game_mode TEXT,
+    time_control INTEGER,
+    start_time TIMESTAMP,
+    end_time TIMESTAMP,
+    move_count INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (white_user_id) REFERENCES users(id),
+    FOREIGN KEY (black_user_id) REFERENCES users(id)
+);
+
+CREATE TABLE IF NOT EXISTS game_moves (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    game_id INTEGER NOT NULL,
+    move_number INTEGER NOT NULL,
+    move_notation TEXT NOT NULL,
+    from_square TEXT,
+    to_square TEXT,
+    position_fen TEXT,
+    white_time_remaining REAL,
+    black_time_remaining REAL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (game_id) REFERENCES games(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS visitor_count (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    count INTEGER DEFAULT 0
+);
+
+INSERT OR IGNORE INTO visitor_count (id, count) VALUES (1, 0);
+
+CREATE TABLE IF NOT EXISTS password_reset_codes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    email TEXT NOT NULL,
+    code TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL,
+    used INTEGER DEFAULT 0,
+    FOREIGN KEY (user_id) REFERENCES users(id)
+);
+
+CREATE TABLE IF NOT EXISTS email_verification_codes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT NOT NULL,
+    username TEXT NOT NULL,
+    password_hash TEXT NOT NULL,
+    display_name TEXT,
+    code TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL,
+    verified INTEGER DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS engine_moves (
+    zobrist INTEGER NOT NULL,
+    depth INTEGER NOT NULL,
+    movetime_ms INTEGER NOT NULL,
+    best_move TEXT NOT NULL,
+    score INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (zobrist, depth, movetime_ms)
+);
+
+-- Leaderboard: top ratings among players with at least one game
+CREATE INDEX IF NOT EXISTS idx_users_leaderboard
+ON users (elo_rating DESC) WHERE games_played > 0;
+
+-- Code lookups only ever look at codes that are still unused
+CREATE INDEX IF NOT EXISTS idx_reset_codes_lookup
+ON password_reset_codes (email, code) WHERE used = 0;
+
+CREATE INDEX IF NOT EXISTS idx_verification_codes_lookup
+ON email_verification_codes (email, code) WHERE verified = 0;
+
+COMMIT;
+"""
 
 def create_tables():
     """Create necessary database tables if they don't exist"""
-    conn = get_db_conn()
-    cur = conn.cursor()
-
     try:
-        if USE_POSTGRES:
-            # PostgreSQL table definitions
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    username VARCHAR(50) UNIQUE NOT NULL,
-                    email VARCHAR(255) UNIQUE NOT NULL,
-                    password_hash VARCHAR(255) NOT NULL,
-                    display_name VARCHAR(100),
-                    elo_rating INTEGER DEFAULT 1200,
-                    games_played INTEGER DEFAULT 0,
-                    games_won INTEGER DEFAULT 0,
-                    games_drawn INTEGER DEFAULT 0,
-                    games_lost INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_login TIMESTAMP
-                )
-            """)
-
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS games (
-                    id SERIAL PRIMARY KEY,
-                    room_code VARCHAR(100) NOT NULL,
-                    white_player VARCHAR(100),
-                    black_player VARCHAR(100),
-                    white_user_id INTEGER REFERENCES users(id),
-                    black_user_id INTEGER REFERENCES users(id),
-                    winner VARCHAR(20),
-                    win_reason VARCHAR(50),
-                    game_mode VARCHAR(20),
-                    time_control INTEGER,
-                    start_time TIMESTAMP,
-                    end_time TIMESTAMP,
-                    move_count INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS game_moves (
-                    id SERIAL PRIMARY KEY,
-                    game_id INTEGER NOT NULL REFERENCES games(id) ON DELETE CASCADE,
-                    move_number INTEGER NOT NULL,
-                    move_notation VARCHAR(20) NOT NULL,
-                    from_square VARCHAR(10),
-                    to_square VARCHAR(10),
-                    position_fen TEXT,
-                    white_time_remaining REAL,
-                    black_time_remaining REAL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS visitor_count (
-                    id INTEGER PRIMARY KEY CHECK (id = 1),
-                    count INTEGER DEFAULT 0
-                )
-            """)
-
-            # Insert initial visitor count if not exists
-            cur.execute("""
-                INSERT INTO visitor_count (id, count) VALUES (1, 0)
-                ON CONFLICT (id) DO NOTHING
-            """)
-
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS password_reset_codes (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER NOT NULL REFERENCES users(id),
-                    email VARCHAR(255) NOT NULL,
-                    code VARCHAR(10) NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    expires_at TIMESTAMP NOT NULL,
-                    used INTEGER DEFAULT 0
-                )
-            """)
-
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS email_verification_codes (
-                    id SERIAL PRIMARY KEY,
-                    email VARCHAR(255) NOT NULL,
-                    username VARCHAR(50) NOT NULL,
-                    password_hash VARCHAR(255) NOT NULL,
-                    display_name VARCHAR(100),
-                    code VARCHAR(10) NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    expires_at TIMESTAMP NOT NULL,
-                    verified INTEGER DEFAULT 0
-                )
-            """)
-
-        else:
-            # SQLite table definitions
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    email TEXT UNIQUE NOT NULL,
-                    password_hash TEXT NOT NULL,
-                    display_name TEXT,
-                    elo_rating INTEGER DEFAULT 1200,
-                    games_played INTEGER DEFAULT 0,
-                    games_won INTEGER DEFAULT 0,
-                    games_drawn INTEGER DEFAULT 0,
-                    games_lost INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_login TIMESTAMP
-                )
-            """)
-
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS games (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    room_code TEXT NOT NULL,
-                    white_player TEXT,
-                    black_player TEXT,
-                    white_user_id INTEGER,
-                    black_user_id INTEGER,
-                    winner TEXT,
-                    win_reason TEXT,
-                    game_mode TEXT,
-                    time_control INTEGER,
-                    start_time TIMESTAMP,
-                    end_time TIMESTAMP,
-                    move_count INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (white_user_id) REFERENCES users(id),
-                    FOREIGN KEY (black_user_id) REFERENCES users(id)
-                )
-            """)
-
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS game_moves (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    game_id INTEGER NOT NULL,
-                    move_number INTEGER NOT NULL,
-                    move_notation TEXT NOT NULL,
-                    from_square TEXT,
-                    to_square TEXT,
-                    position_fen TEXT,
-                    white_time_remaining REAL,
-                    black_time_remaining REAL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (game_id) REFERENCES games(id) ON DELETE CASCADE
-                )
-            """)
-
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS visitor_count (
-                    id INTEGER PRIMARY KEY CHECK (id = 1),
-                    count INTEGER DEFAULT 0
-                )
-            """)
-
-            cur.execute("INSERT OR IGNORE INTO visitor_count (id, count) VALUES (1, 0)")
-
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS password_reset_codes (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    email TEXT NOT NULL,
-                    code TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    expires_at TIMESTAMP NOT NULL,
-                    used INTEGER DEFAULT 0,
-                    FOREIGN KEY (user_id) REFERENCES users(id)
-                )
-            """)
-
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS email_verification_codes (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    email TEXT NOT NULL,
-                    username TEXT NOT NULL,
-                    password_hash TEXT NOT NULL,
-                    display_name TEXT,
-                    code TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    expires_at TIMESTAMP NOT NULL,
-                    verified INTEGER DEFAULT 0
-                )
-            """)
-
-        conn.commit()
-        print("✅ Database tables created/verified")
+        with db_cursor() as cur:
+            if USE_POSTGRES:
+                # Parameterless, so psycopg sends every statement in one round-trip
+                cur.execute(DDL_POSTGRES)
+            else:
+                cur.executescript(DDL_SQLITE)
+        log.info("✅ Database tables created/verified")
 
     except Exception as e:
-        print(f"❌ Error creating tables: {e}")
-        traceback.print_exc()
-        conn.rollback()
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
+        log.error("❌ Error creating tables: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
 
 # ===== VISITOR COUNT FUNCTIONS =====
 
+# Visits are counted in memory and written as one UPDATE per flush interval
+VISITOR_FLUSH_INTERVAL = 5.0
+pending_visits = 0
+pending_visits_lock = threading.Lock()
+visitor_flusher = None
+# Last stored count read from the database as (count, expiry), reused for
+# VISITOR_COUNT_TTL seconds by get_total_visitor_count
+VISITOR_COUNT_TTL = 5.0
+stored_visits = None
+
 def increment_visitor_count():
-    """Increment the visitor counter"""
-    conn = get_db_conn()
+    """Count a visit; the background flusher adds it to the stored total"""
+    global pending_visits, visitor_flusher
+    with pending_visits_lock:
+        pending_visits += 1
+        if visitor_flusher is None:
+            visitor_flusher = threading.Thread(target=_visitor_flush_loop, daemon=True)
+            visitor_flusher.start()
+
+def _visitor_flush_loop():
+    """Periodically write buffered visits"""
+    while True:
+        time.sleep(VISITOR_FLUSH_INTERVAL)
+        flush_visitor_count()
+
+SQL_FLUSH_VISITOR_COUNT = f"UPDATE visitor_count SET count = count + {PH} WHERE id = 1"
+
+def flush_visitor_count():
+    """Add buffered visits to the visitor counter in one UPDATE"""
+    global pending_visits, stored_visits
+    with pending_visits_lock:
+        delta = pending_visits
+        pending_visits = 0
+    if not delta:
+        return True
+
     try:
-        cur = conn.cursor()
-        cur.execute("UPDATE visitor_count SET count = count + 1 WHERE id = 1")
-        conn.commit()
-        print("👁️ Visitor count incremented")
+        execute_write(SQL_FLUSH_VISITOR_COUNT, [(delta,)])
+        with pending_visits_lock:
+            if stored_visits is not None:
+                stored_visits = (stored_visits[0] + delta, stored_visits[1])
+        log.debug("👁️ Visitor count incremented by %s", delta)
+        return True
     except Exception as e:
-        print(f"❌ Error incrementing visitor count: {e}")
-        traceback.print_exc()
-        conn.rollback()
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
+        log.error("❌ Error incrementing visitor count: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
+        # Keep the visits for the next flush
+        with pending_visits_lock:
+            pending_visits += delta
+        return False
 
+@retry_on_db_error
 def get_total_visitor_count():
-    """Get total visitor count"""
-    conn = get_db_conn()
+    """Get total visitor count, including visits not flushed yet"""
+    global stored_visits
+    with pending_visits_lock:
+        if stored_visits is not None and stored_visits[1] > time.monotonic():
+            return stored_visits[0] + pending_visits
+
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT count FROM visitor_count WHERE id = 1")
-        result = cur.fetchone()
-        if result:
-            # For both PostgreSQL and SQLite, result is a tuple when using regular cursor
-            count = result[0] if isinstance(result, tuple) else result['count']
-            return count
-        return 0
+        with db_cursor(read_only=True) as cur:
+            cur.execute("SELECT count FROM visitor_count WHERE id = 1")
+            result = cur.fetchone()
+            if result:
+                count = result['count']
+            else:
+                count = 0
+            with pending_visits_lock:
+                stored_visits = (count, time.monotonic() + VISITOR_COUNT_TTL)
+                return count + pending_visits
     except Exception as e:
-        print(f"❌ Error getting visitor count: {e}")
-        traceback.print_exc()
+        log.error("❌ Error getting visitor count: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return 0
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
 
 # ===== USER FUNCTIONS =====
 
+# Short-lived LRU of user rows keyed by ("id" | "username" | "email", value).
+# Any write to users clears it, so a stale row lives at most USER_CACHE_TTL.
+USER_CACHE_TTL = 60
+USER_CACHE_SIZE = 2048
+user_cache = OrderedDict()
+user_cache_lock = threading.Lock()
+
+# Leaderboard rows per limit. Ratings only move when a game is saved, which
+# clears this along with the user cache; the TTL covers writes from other workers.
+leaderboard_cache = {}
+
+def _cached_user(key):
+    """Return a copy of the cached user for key, or None"""
+    with user_cache_lock:
+        entry = user_cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del user_cache[key]
+            return None
+        user_cache.move_to_end(key)
+        return dict(entry[1])
+
+def _cache_user(key, user):
+    with user_cache_lock:
+        user_cache[key] = (time.monotonic() + USER_CACHE_TTL, dict(user))
+        user_cache.move_to_end(key)
+        if len(user_cache) > USER_CACHE_SIZE:
+            user_cache.popitem(last=False)
+
+def invalidate_user_cache():
+    """Drop every cached user row (and the leaderboard) after a write to the users table"""
+    with user_cache_lock:
+        user_cache.clear()
+        leaderboard_cache.clear()
+
+SQL_GET_USER_BY_ID = f"""
+    SELECT id, username, email, password_hash, display_name,
+           elo_rating, games_played, games_won, games_drawn, games_lost,
+           created_at, last_login
+    FROM users WHERE id = {PH}
+"""
+
+@retry_on_db_error
 def get_user_by_id(user_id):
     """Get user by ID"""
-    conn = get_db_conn()
+    key = ("id", user_id)
+    user = _cached_user(key)
+    if user is not None:
+        return user
+
     try:
-        if USE_POSTGRES:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-        else:
-            cur = conn.cursor()
-
-        placeholder = '%s' if USE_POSTGRES else '?'
-        cur.execute(f"""
-            SELECT id, username, email, password_hash, display_name,
-                   elo_rating, games_played, games_won, games_drawn, games_lost,
-                   created_at, last_login
-            FROM users WHERE id = {placeholder}
-        """, (user_id,))
-
-        row = cur.fetchone()
-        if row:
-            return dict(row)
-        return None
+        with db_cursor(read_only=True) as cur:
+            cur.execute(SQL_GET_USER_BY_ID, (user_id,), **PREPARE_NOW)
+
+            row = cur.fetchone()
+            if row:
+                _cache_user(key, row)
+            return row
     except Exception as e:
-        print(f"❌ Error getting user by id: {e}")
-        traceback.print_exc()
+        log.error("❌ Error getting user by id: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return None
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
 
+SQL_GET_USER_BY_USERNAME = f"""
+    SELECT id, username, email, password_hash, display_name,
+           elo_rating, games_played, games_won, games_drawn, games_lost,
+           created_at, last_login
+    FROM users WHERE username = {PH}
+"""
+
+@retry_on_db_error
 def get_user_by_username(username):
     """Get user by username"""
-    conn = get_db_conn()
+    key = ("username", username)
+    user = _cached_user(key)
+    if user is not None:
+        return user
+
     try:
-        if USE_POSTGRES:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-        else:
-            cur = conn.cursor()
-
-        placeholder = '%s' if USE_POSTGRES else '?'
-        cur.execute(f"""
-            SELECT id, username, email, password_hash, display_name,
-                   elo_rating, games_played, games_won, games_drawn, games_lost,
-                   created_at, last_login
-            FROM users WHERE username = {placeholder}
-        """, (username,))
-
-        row = cur.fetchone()
-        if row:
-            return dict(row)
-        return None
+        with db_cursor(read_only=True) as cur:
+            cur.execute(SQL_GET_USER_BY_USERNAME, (username,), **PREPARE_NOW)
+
+            row = cur.fetchone()
+            if row:
+                _cache_user(key, row)
+            return row
     except Exception as e:
-        print(f"❌ Error getting user by username: {e}")
-        traceback.print_exc()
+        log.error("❌ Error getting user by username: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return None
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
 
 def create_user(username, email, password_hash, display_name=None):
-    """Create a new user"""
-    conn = get_db_conn()
+    """Create a new user; returns None if the username or email is taken"""
     try:
-        print(f"📝 Creating user: {username}, email: {email}")
-        if USE_POSTGRES:
-            cur = conn.cursor()
-            cur.execute("""
-                INSERT INTO users (username, email, password_hash, display_name)
-                VALUES (%s, %s, %s, %s)
-                RETURNING id
-            """, (username, email, password_hash, display_name or username))
-            result = cur.fetchone()
-            user_id = result[0] if result else None
-            print(f"✅ PostgreSQL INSERT returned user_id: {user_id}")
-        else:
-            cur = conn.cursor()
-            cur.execute("""
-                INSERT INTO users (username, email, password_hash, display_name)
-                VALUES (?, ?, ?, ?)
-            """, (username, email, password_hash, display_name or username))
-            user_id = cur.lastrowid
-
-        conn.commit()
-        print(f"✅ User created successfully with ID: {user_id}")
+        with db_cursor() as cur:
+            log.debug("📝 Creating user: %s, email: %s", username, email)
+            # The unique constraints decide atomically; no separate existence check
+            if USE_POSTGRES:
+                cur.execute("""
+                    INSERT INTO users (username, email, password_hash, display_name)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT DO NOTHING
+                    RETURNING id
+                """, (username, email, password_hash, display_name or username))
+                result = cur.fetchone()
+                user_id = result['id'] if result else None
+            else:
+                # ON CONFLICT (not OR IGNORE) so NOT NULL/CHECK failures still raise
+                cur.execute("""
+                    INSERT INTO users (username, email, password_hash, display_name)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT DO NOTHING
+                """, (username, email, password_hash, display_name or username))
+                user_id = cur.lastrowid if cur.rowcount else None
+        if user_id is None:
+            log.warning("⚠️ Username or email already taken: %s", username)
+            return None
+        invalidate_user_cache()
+        log.info("✅ User created successfully with ID: %s", user_id)
         return user_id
     except Exception as e:
-        print(f"❌ Error creating user: {e}")
-        traceback.print_exc()
-        conn.rollback()
+        log.error("❌ Error creating user: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return None
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
+
+# Logins are recorded in memory (latest time per user) and written in one
+# statement per flush interval
+LAST_LOGIN_FLUSH_INTERVAL = 5.0
+pending_logins = {}
+pending_logins_lock = threading.Lock()
+last_login_flusher = None
 
 def update_last_login(user_id):
-    """Update user's last login time"""
-    conn = get_db_conn()
+    """Record a login; the background flusher writes it to users.last_login"""
+    global last_login_flusher
+    with pending_logins_lock:
+        pending_logins[user_id] = datetime.utcnow().replace(microsecond=0)
+        if last_login_flusher is None:
+            last_login_flusher = threading.Thread(target=_last_login_flush_loop, daemon=True)
+            last_login_flusher.start()
+
+def _last_login_flush_loop():
+    """Periodically write buffered logins"""
+    while True:
+        time.sleep(LAST_LOGIN_FLUSH_INTERVAL)
+        flush_last_logins()
+
+def flush_last_logins():
+    """Write every buffered login time in one UPDATE"""
+    global pending_logins
+    with pending_logins_lock:
+        logins = pending_logins
+        pending_logins = {}
+    if not logins:
+        return True
+
     try:
-        cur = conn.cursor()
-        placeholder = '%s' if USE_POSTGRES else '?'
-        cur.execute(f"""
-            UPDATE users SET last_login = CURRENT_TIMESTAMP
-            WHERE id = {placeholder}
-        """, (user_id,))
-        conn.commit()
-    except Exception as e:
-        print(f"❌ Error updating last login: {e}")
-        traceback.print_exc()
-        conn.rollback()
-    finally:
         if USE_POSTGRES:
-            release_db_conn(conn)
+            values = ", ".join(["(%s::int, %s::timestamp)"] * len(logins))
+            with db_cursor() as cur:
+                cur.execute(f"""
+                    UPDATE users u SET last_login = v.ts
+                    FROM (VALUES {values}) AS v(user_id, ts)
+                    WHERE u.id = v.user_id
+                """, [value for item in logins.items() for value in item])
+        else:
+            execute_write("UPDATE users SET last_login = ? WHERE id = ?",
+                          [(ts.strftime('%Y-%m-%d %H:%M:%S'), user_id)
+                           for user_id, ts in logins.items()])
+        # No invalidate_user_cache(): a cached row's last_login may lag by up
+        # to USER_CACHE_TTL, which beats emptying the user and leaderboard
+        # caches on every flush
+        return True
+    except Exception as e:
+        log.error("❌ Error updating last login: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
+        # Keep the logins for the next flush unless a newer one arrived
+        with pending_logins_lock:
+            for user_id, ts in logins.items():
+                pending_logins.setdefault(user_id, ts)
+        return False
+
+@atexit.register
+def flush_buffered_writes():
+    """On a clean shutdown, write out visits and logins still waiting for a flush"""
+    flush_visitor_count()
+    flush_last_logins()
+    stop_sqlite_writer()
 
 def get_user_profile(username):
     """Get user profile information"""
     return get_user_by_username(username)
 
+# Email arguments arrive already stripped and lower-cased by the auth routes
+# in app.py; the functions below pass them to SQL unchanged.
+SQL_GET_USER_BY_EMAIL = f"""
+    SELECT id, username, email, password_hash, display_name,
+           elo_rating, games_played, games_won, games_drawn, games_lost,
+           created_at, last_login
+    FROM users WHERE email = {PH}
+"""
+
+@retry_on_db_error
 def get_user_by_email(email):
     """Get user by email address"""
-    conn = get_db_conn()
+    key = ("email", email)
+    user = _cached_user(key)
+    if user is not None:
+        return user
+
     try:
-        if USE_POSTGRES:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-        else:
-            cur = conn.cursor()
-
-        placeholder = '%s' if USE_POSTGRES else '?'
-        cur.execute(f"""
-            SELECT id, username, email, password_hash, display_name,
-                   elo_rating, games_played, games_won, games_drawn, games_lost,
-                   created_at, last_login
-            FROM users WHERE email = {placeholder}
-        """, (email.lower(),))
-
-        row = cur.fetchone()
-        if row:
-            return dict(row)
-        return None
+        with db_cursor(read_only=True) as cur:
+            cur.execute(SQL_GET_USER_BY_EMAIL, (email,), **PREPARE_NOW)
+
+            row = cur.fetchone()
+            if row:
+                _cache_user(key, row)
+            return row
     except Exception as e:
-        print(f"❌ Error getting user by email: {e}")
-        traceback.print_exc()
+        log.error("❌ Error getting user by email: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return None
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
+
+SQL_UPDATE_USER_PASSWORD = f"""
+    UPDATE users SET password_hash = {PH}
+    WHERE id = {PH}
+"""
 
 def update_user_password(user_id, new_password_hash):
     """Update user's password"""
-    conn = get_db_conn()
     try:
-        cur = conn.cursor()
-        placeholder = '%s' if USE_POSTGRES else '?'
-        cur.execute(f"""
-            UPDATE users SET password_hash = {placeholder}
-            WHERE id = {placeholder}
-        """, (new_password_hash, user_id))
-        conn.commit()
+        with db_cursor() as cur:
+            cur.execute(SQL_UPDATE_USER_PASSWORD, (new_password_hash, user_id))
+        invalidate_user_cache()
         return True
     except Exception as e:
-        print(f"❌ Error updating password: {e}")
-        traceback.print_exc()
-        conn.rollback()
+        log.error("❌ Error updating password: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return False
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
+
+SQL_EXPIRE_RESET_CODES = f"""
+    UPDATE password_reset_codes SET used = 1
+    WHERE user_id = {PH} AND used = 0
+"""
+SQL_CREATE_RESET_CODE = f"""
+    INSERT INTO password_reset_codes (user_id, email, code, expires_at)
+    VALUES ({PH}, {PH}, {PH}, {PH})
+"""
 
 def create_reset_code(user_id, email, code, expires_at):
     """Create a password reset code"""
-    conn = get_db_conn()
     try:
-        cur = conn.cursor()
-        placeholder = '%s' if USE_POSTGRES else '?'
-
-        # Invalidate any existing unused codes for this user
-        cur.execute(f"""
-            UPDATE password_reset_codes SET used = 1
-            WHERE user_id = {placeholder} AND used = 0
-        """, (user_id,))
-
-        # Create new code
-        cur.execute(f"""
-            INSERT INTO password_reset_codes (user_id, email, code, expires_at)
-            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder})
-        """, (user_id, email.lower(), code, expires_at))
-        conn.commit()
-        print(f"✅ Reset code created for user {user_id}")
+        with db_cursor() as cur:
+            # Invalidate any existing unused codes for this user
+            cur.execute(SQL_EXPIRE_RESET_CODES, (user_id,))
+
+            # Create new code
+            cur.execute(SQL_CREATE_RESET_CODE, (user_id, email, code, expires_at))
+        log.info("✅ Reset code created for user %s", user_id)
         return True
     except Exception as e:
-        print(f"❌ Error creating reset code: {e}")
-        traceback.print_exc()
-        conn.rollback()
+        log.error("❌ Error creating reset code: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return False
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
 
+SQL_VERIFY_RESET_CODE = f"""
+    SELECT user_id FROM password_reset_codes
+    WHERE email = {PH} AND code = {PH} AND used = 0
+      AND expires_at > {NOW_UTC}
+    ORDER BY created_at DESC
+    LIMIT 1
+"""
+
+@retry_on_db_error
 def verify_reset_code(email, code):
     """Verify a password reset code and return user_id if valid"""
-    conn = get_db_conn()
     try:
-        if USE_POSTGRES:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-        else:
-            cur = conn.cursor()
-
-        placeholder = '%s' if USE_POSTGRES else '?'
-        cur.execute(f"""
-            SELECT user_id, expires_at FROM password_reset_codes
-            WHERE email = {placeholder} AND code = {placeholder} AND used = 0
-            ORDER BY created_at DESC
-            LIMIT 1
-        """, (email.lower(), code))
-
-        row = cur.fetchone()
-        if not row:
-            return None
-
-        # Convert to dict properly
-        row_dict = dict(row)
-
-        # Check if code has expired
-        expires_at = row_dict['expires_at']
-        if isinstance(expires_at, str):
-            expires_at = datetime.strptime(expires_at, '%Y-%m-%d %H:%M:%S')
+        with db_cursor(read_only=True) as cur:
+            cur.execute(SQL_VERIFY_RESET_CODE, (email, code))
 
-        if datetime.utcnow() > expires_at:
-            print(f"⚠️ Reset code expired for {email}")
-            return None
+            row = cur.fetchone()
+            if not row:
+                return None
 
-        return row_dict['user_id']
+            return row['user_id']
     except Exception as e:
-        print(f"❌ Error verifying reset code: {e}")
-        traceback.print_exc()
+        log.error("❌ Error verifying reset code: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return None
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
+
+SQL_MARK_RESET_CODE_USED = f"""
+    UPDATE password_reset_codes SET used = 1
+    WHERE email = {PH} AND code = {PH}
+"""
 
 def mark_reset_code_used(email, code):
     """Mark a reset code as used"""
-    conn = get_db_conn()
     try:
-        cur = conn.cursor()
-        placeholder = '%s' if USE_POSTGRES else '?'
-        cur.execute(f"""
-            UPDATE password_reset_codes SET used = 1
-            WHERE email = {placeholder} AND code = {placeholder}
-        """, (email.lower(), code))
-        conn.commit()
+        execute_write(SQL_MARK_RESET_CODE_USED, [(email, code)])
         return True
     except Exception as e:
-        print(f"❌ Error marking reset code as used: {e}")
-        traceback.print_exc()
-        conn.rollback()
+        log.error("❌ Error marking reset code as used: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return False
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
 
 # ===== EMAIL VERIFICATION FUNCTIONS =====
 
+SQL_DELETE_VERIFICATION_CODES = f"""
+    DELETE FROM email_verification_codes
+    WHERE email = {PH} AND verified = 0
+"""
+SQL_CREATE_VERIFICATION_CODE = f"""
+    INSERT INTO email_verification_codes (email, username, password_hash, display_name, code, expires_at)
+    VALUES ({PH}, {PH}, {PH}, {PH}, {PH}, {PH})
+"""
+
 def create_verification_code(email, username, password_hash, display_name, code, expires_at):
     """Create an email verification code for registration"""
-    conn = get_db_conn()
     try:
-        cur = conn.cursor()
-        placeholder = '%s' if USE_POSTGRES else '?'
-
-        # Remove any existing unverified codes for this email
-        cur.execute(f"""
-            DELETE FROM email_verification_codes
-            WHERE email = {placeholder} AND verified = 0
-        """, (email.lower(),))
-
-        # Create new verification code
-        cur.execute(f"""
-            INSERT INTO email_verification_codes (email, username, password_hash, display_name, code, expires_at)
-            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
-        """, (email.lower(), username, password_hash, display_name, code, expires_at))
-        conn.commit()
-        print(f"✅ Verification code created for {email}")
+        with db_cursor() as cur:
+            # Remove any existing unverified codes for this email
+            cur.execute(SQL_DELETE_VERIFICATION_CODES, (email,))
+
+            # Create new verification code
+            cur.execute(SQL_CREATE_VERIFICATION_CODE, (email, username, password_hash, display_name, code, expires_at))
+        log.info("✅ Verification code created for %s", email)
         return True
     except Exception as e:
-        print(f"❌ Error creating verification code: {e}")
-        traceback.print_exc()
-        conn.rollback()
+        log.error("❌ Error creating verification code: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return False
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
 
+SQL_VERIFY_EMAIL_CODE = f"""
+    SELECT username, password_hash, display_name
+    FROM email_verification_codes
+    WHERE email = {PH} AND code = {PH} AND verified = 0
+      AND expires_at > {NOW_UTC}
+    ORDER BY created_at DESC
+    LIMIT 1
+"""
+
+@retry_on_db_error
 def verify_email_code(email, code):
     """Verify email code and return registration data if valid"""
-    conn = get_db_conn()
     try:
-        if USE_POSTGRES:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-        else:
-            cur = conn.cursor()
-
-        placeholder = '%s' if USE_POSTGRES else '?'
-        cur.execute(f"""
-            SELECT username, password_hash, display_name, expires_at
-            FROM email_verification_codes
-            WHERE email = {placeholder} AND code = {placeholder} AND verified = 0
-            ORDER BY created_at DESC
-            LIMIT 1
-        """, (email.lower(), code))
-
-        row = cur.fetchone()
-        if not row:
-            print(f"⚠️ No verification code found for {email} with code {code}")
-            return None
-
-        # Convert to dict properly
-        row_dict = dict(row)
-
-        # Check if code has expired
-        expires_at = row_dict['expires_at']
-        if isinstance(expires_at, str):
-            expires_at = datetime.strptime(expires_at, '%Y-%m-%d %H:%M:%S')
+        with db_cursor(read_only=True) as cur:
+            cur.execute(SQL_VERIFY_EMAIL_CODE, (email, code))
 
-        if datetime.utcnow() > expires_at:
-            print(f"⚠️ Verification code expired for {email}")
-            return None
+            row = cur.fetchone()
+            if not row:
+                log.warning("⚠️ No unexpired verification code found for %s with code %s", email, code)
+                return None
 
-        return {
-            'username': row_dict['username'],
-            'password_hash': row_dict['password_hash'],
-            'display_name': row_dict['display_name']
-        }
+            return row
     except Exception as e:
-        print(f"❌ Error verifying email code: {e}")
-        traceback.print_exc()
+        log.error("❌ Error verifying email code: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return None
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
+
+SQL_MARK_EMAIL_VERIFIED = f"""
+    UPDATE email_verification_codes SET verified = 1
+    WHERE email = {PH} AND code = {PH}
+"""
 
 def mark_email_verified(email, code):
     """Mark email verification code as verified"""
-    conn = get_db_conn()
     try:
-        cur = conn.cursor()
-        placeholder = '%s' if USE_POSTGRES else '?'
-        cur.execute(f"""
-            UPDATE email_verification_codes SET verified = 1
-            WHERE email = {placeholder} AND code = {placeholder}
-        """, (email.lower(), code))
-        conn.commit()
+        execute_write(SQL_MARK_EMAIL_VERIFIED, [(email, code)])
         return True
     except Exception as e:
-        print(f"❌ Error marking email as verified: {e}")
-        traceback.print_exc()
-        conn.rollback()
+        log.error("❌ Error marking email as verified: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return False
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
 
+SQL_CHECK_USERNAME_EXISTS = f"SELECT id FROM users WHERE username = {PH}"
+
+@retry_on_db_error
 def check_username_exists(username):
     """Check if username already exists"""
-    conn = get_db_conn()
     try:
-        cur = conn.cursor()
-        placeholder = '%s' if USE_POSTGRES else '?'
-        cur.execute(f"SELECT id FROM users WHERE username = {placeholder}", (username,))
-        return cur.fetchone() is not None
+        with db_cursor(read_only=True) as cur:
+            cur.execute(SQL_CHECK_USERNAME_EXISTS, (username,), **PREPARE_NOW)
+            return cur.fetchone() is not None
     except Exception as e:
-        print(f"❌ Error checking username: {e}")
-        traceback.print_exc()
+        log.error("❌ Error checking username: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return False
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
 
+SQL_CHECK_EMAIL_EXISTS = f"SELECT id FROM users WHERE email = {PH}"
+
+@retry_on_db_error
 def check_email_exists(email):
     """Check if email already exists"""
-    conn = get_db_conn()
     try:
-        cur = conn.cursor()
-        placeholder = '%s' if USE_POSTGRES else '?'
-        cur.execute(f"SELECT id FROM users WHERE email = {placeholder}", (email.lower(),))
-        return cur.fetchone() is not None
+        with db_cursor(read_only=True) as cur:
+            cur.execute(SQL_CHECK_EMAIL_EXISTS, (email,), **PREPARE_NOW)
+            return cur.fetchone() is not None
     except Exception as e:
-        print(f"❌ Error checking email: {e}")
-        traceback.print_exc()
+        log.error("❌ Error checking email: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
+        return False
+
+# ===== ENGINE CACHE FUNCTIONS =====
+
+# Engine results are written by a single background writer in batches
+engine_cache_queue = queue.Queue()
+engine_cache_writer = None
+engine_cache_writer_lock = threading.Lock()
+ENGINE_CACHE_BATCH_SIZE = 64
+
+# In-process LRU in front of the table, keyed like it by
+# (zobrist, depth, movetime_ms), so hot positions skip the database
+ENGINE_MOVE_CACHE_SIZE = 4096
+engine_move_cache = OrderedDict()
+engine_move_cache_lock = threading.Lock()
+
+def _signed_zobrist(zobrist):
+    """Map an unsigned 64-bit Zobrist hash onto a signed BIGINT"""
+    return zobrist - (1 << 64) if zobrist >= (1 << 63) else zobrist
+
+def _cache_engine_move(key, best_move):
+    with engine_move_cache_lock:
+        engine_move_cache[key] = best_move
+        engine_move_cache.move_to_end(key)
+        if len(engine_move_cache) > ENGINE_MOVE_CACHE_SIZE:
+            engine_move_cache.popitem(last=False)
+
+SQL_GET_CACHED_ENGINE_MOVE = f"""
+    SELECT best_move FROM engine_moves
+    WHERE zobrist = {PH} AND depth = {PH} AND movetime_ms = {PH}
+"""
+
+@retry_on_db_error
+def get_cached_engine_move(zobrist, depth, movetime_ms):
+    """Get the stored best move (UCI) for a position searched with this depth and time"""
+    key = (_signed_zobrist(zobrist), depth, movetime_ms)
+    with engine_move_cache_lock:
+        best_move = engine_move_cache.get(key)
+        if best_move is not None:
+            engine_move_cache.move_to_end(key)
+            return best_move
+    try:
+        with db_cursor(read_only=True) as cur:
+            cur.execute(SQL_GET_CACHED_ENGINE_MOVE, key)
+            result = cur.fetchone()
+    except Exception as e:
+        log.error("❌ Error reading engine cache: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
+        return None
+    if result is None:
+        return None
+    _cache_engine_move(key, result['best_move'])
+    return result['best_move']
+
+def queue_engine_move(zobrist, depth, movetime_ms, best_move, score=None):
+    """Cache an engine result and queue it for the background writer"""
+    global engine_cache_writer
+    key = (_signed_zobrist(zobrist), depth, movetime_ms)
+    _cache_engine_move(key, best_move)
+    engine_cache_queue.put((*key, best_move, score))
+    with engine_cache_writer_lock:
+        if engine_cache_writer is None:
+            engine_cache_writer = threading.Thread(target=_engine_cache_writer_loop, daemon=True)
+            engine_cache_writer.start()
+
+def _engine_cache_writer_loop():
+    """Drain queued engine results and upsert them in batches"""
+    while True:
+        rows = [engine_cache_queue.get()]
+        while len(rows) < ENGINE_CACHE_BATCH_SIZE:
+            try:
+                rows.append(engine_cache_queue.get_nowait())
+            except queue.Empty:
+                break
+        save_engine_moves(rows)
+
+def save_engine_moves(rows):
+    """Upsert (zobrist, depth, movetime_ms, best_move, score) rows into the engine cache"""
+    try:
+        with db_cursor() as cur:
+            if USE_POSTGRES:
+                cur.executemany("""
+                    INSERT INTO engine_moves (zobrist, depth, movetime_ms, best_move, score)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (zobrist, depth, movetime_ms)
+                    DO UPDATE SET best_move = EXCLUDED.best_move, score = EXCLUDED.score
+                """, rows)
+            else:
+                cur.executemany("""
+                    INSERT OR REPLACE INTO engine_moves (zobrist, depth, movetime_ms, best_move, score)
+                    VALUES (?, ?, ?, ?, ?)
+                """, rows)
+        return True
+    except Exception as e:
+        log.error("❌ Error writing engine cache: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return False
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
 
 # ===== GAME FUNCTIONS =====
 
+SQL_INSERT_GAME = f"""
+    INSERT INTO games (
+        room_code, white_player, black_player,
+        white_user_id, black_user_id, winner, win_reason,
+        game_mode, time_control, start_time, end_time, move_count
+    ) VALUES ({", ".join([PH] * 12)})
+    {"RETURNING id" if USE_POSTGRES else ""}
+"""
+
+# PostgreSQL: the game row and all of its moves in one statement. Moves arrive
+# as one array per column and unnest back into rows, numbered by ordinality.
+SQL_INSERT_GAME_WITH_MOVES = f"""
+    WITH new_game AS ({SQL_INSERT_GAME}),
+    new_moves AS (
+        INSERT INTO game_moves (
+            game_id, move_number, move_notation, from_square, to_square,
+            position_fen, white_time_remaining, black_time_remaining
+        )
+        SELECT new_game.id, m.move_number, m.notation, m.from_square, m.to_square,
+               m.fen, m.white_time, m.black_time
+        FROM new_game, unnest(
+            %s::text[], %s::text[], %s::text[], %s::text[], %s::real[], %s::real[]
+        ) WITH ORDINALITY AS m(notation, from_square, to_square, fen, white_time, black_time, move_number)
+    )
+    SELECT id FROM new_game
+"""
+
+SQL_INSERT_GAME_MOVES = f"""
+    INSERT INTO game_moves (
+        game_id, move_number, move_notation, from_square, to_square,
+        position_fen, white_time_remaining, black_time_remaining
+    ) VALUES ({", ".join([PH] * 8)})
+"""
+
+# Fields of each move_history entry, in the column order of both move inserts.
+# app.py always fills all of them.
+MOVE_FIELDS = itemgetter('notation', 'from_square', 'to_square', 'fen', 'white_time', 'black_time')
+
 def save_game_record(room, game_data, start_time, end_time, win_reason):
     """Save a completed game to database"""
-    print(f"🎮 Saving game record for room: {room}")
-    print(f"   Game data keys: {list(game_data.keys())}")
-    conn = get_db_conn()
+    log.debug("🎮 Saving game record for room: %s", room)
     try:
-        cur = conn.cursor()
-
-        # Extract game data
-        white_player = game_data.get('white_player', 'Unknown')
-        black_player = game_data.get('black_player', 'Unknown')
-        white_user_id = game_data.get('white_user_id')
-        black_user_id = game_data.get('black_user_id')
-        winner = game_data.get('winner')
-        game_mode = game_data.get('game_mode', 'friend')
-        time_control = int(game_data.get('whiteTime', 300))
-        move_history = game_data.get('move_history', [])
-
-        print(f"   White: {white_player} (user_id: {white_user_id})")
-        print(f"   Black: {black_player} (user_id: {black_user_id})")
-        print(f"   Winner: {winner}, Reason: {win_reason}")
-        print(f"   Move count: {len(move_history)}")
-
-        # Insert game record
-        if USE_POSTGRES:
-            cur.execute("""
-                INSERT INTO games (
-                    room_code, white_player, black_player,
-                    white_user_id, black_user_id, winner, win_reason,
-                    game_mode, time_control, start_time, end_time, move_count
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING id
-            """, (
+        with db_cursor() as cur:
+            # Extract game data
+            white_player = game_data.get('white_player', 'Unknown')
+            black_player = game_data.get('black_player', 'Unknown')
+            white_user_id = game_data.get('white_user_id')
+            black_user_id = game_data.get('black_user_id')
+            winner = game_data.get('winner')
+            game_mode = game_data.get('game_mode', 'friend')
+            time_control = int(game_data.get('whiteTime', 300))
+            move_history = game_data.get('move_history', [])
+
+            log.debug("   White: %s (user_id: %s), Black: %s (user_id: %s), Winner: %s, Reason: %s, Moves: %d",
+                      white_player, white_user_id, black_player, black_user_id,
+                      winner, win_reason, len(move_history))
+
+            # Registered players whose statistics this game updates (not bots or guests)
+            players = []
+            if white_user_id:
+                players.append((white_user_id, 'white'))
+            if black_user_id:
+                players.append((black_user_id, 'black'))
+
+            # Insert game record
+            game_row = (
                 room, white_player, black_player,
                 white_user_id, black_user_id, winner, win_reason,
                 game_mode, time_control, start_time, end_time, len(move_history)
-            ))
-            result = cur.fetchone()
-            game_id = result[0] if result else None
-        else:
-            cur.execute("""
-                INSERT INTO games (
-                    room_code, white_player, black_player,
-                    white_user_id, black_user_id, winner, win_reason,
-                    game_mode, time_control, start_time, end_time, move_count
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                room, white_player, black_player,
-                white_user_id, black_user_id, winner, win_reason,
-                game_mode, time_control, start_time, end_time, len(move_history)
-            ))
-            game_id = cur.lastrowid
-
-        print(f"   Game ID: {game_id}")
-
-        # Save move history for replay
-        for i, move in enumerate(move_history):
+            )
             if USE_POSTGRES:
-                cur.execute("""
-                    INSERT INTO game_moves (
-                        game_id, move_number, move_notation, from_square, to_square,
-                        position_fen, white_time_remaining, black_time_remaining
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                """, (
-                    game_id, i + 1, move.get('notation', ''),
-                    move.get('from_square', ''), move.get('to_square', ''),
-                    move.get('fen', ''),
-                    move.get('white_time', 0), move.get('black_time', 0)
-                ))
+                # One list per column; times as floats, since psycopg won't
+                # dump an int/float mix as a real[] array
+                move_columns = [list(column) for column in zip(*map(MOVE_FIELDS, move_history))] or [[]] * 6
+                move_columns[4] = list(map(float, move_columns[4]))
+                move_columns[5] = list(map(float, move_columns[5]))
+                # Game, moves and stats update in one pipelined round-trip.
+                # Stats go on their own cursor so the new game id is still on
+                # this one afterwards.
+                with cur.connection.pipeline():
+                    cur.execute(SQL_INSERT_GAME_WITH_MOVES, game_row + tuple(move_columns))
+                    update_user_stats(cur.connection.cursor(), winner, players)
+                result = cur.fetchone()
+                game_id = result['id'] if result else None
             else:
-                cur.execute("""
-                    INSERT INTO game_moves (
-                        game_id, move_number, move_notation, from_square, to_square,
-                        position_fen, white_time_remaining, black_time_remaining
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    game_id, i + 1, move.get('notation', ''),
-                    move.get('from_square', ''), move.get('to_square', ''),
-                    move.get('fen', ''),
-                    move.get('white_time', 0), move.get('black_time', 0)
-                ))
-
-        # Update user statistics
-        print(f"📊 Updating stats - White user: {white_user_id}, Black user: {black_user_id}, Winner: {winner}")
-        if white_user_id:
-            update_user_stats(cur, white_user_id, winner, 'white')
-            print(f"   ✓ Updated stats for white player (user_id: {white_user_id})")
-        else:
-            print(f"   ⚠️ No white_user_id - stats not updated")
-        if black_user_id:
-            update_user_stats(cur, black_user_id, winner, 'black')
-            print(f"   ✓ Updated stats for black player (user_id: {black_user_id})")
-        else:
-            print(f"   ⚠️ No black_user_id - stats not updated (bot game or guest)")
-
-        conn.commit()
-        print(f"✅ Game {room} saved to database (ID: {game_id})")
+                cur.execute(SQL_INSERT_GAME, game_row)
+                game_id = cur.lastrowid
+                update_user_stats(cur, winner, players)
+                # Save move history for replay in a single executemany
+                if move_history:
+                    cur.executemany(SQL_INSERT_GAME_MOVES, [
+                        (game_id, i, *MOVE_FIELDS(move))
+                        for i, move in enumerate(move_history, 1)
+                    ])
+
+            log.debug("   Game ID: %s", game_id)
+        invalidate_user_cache()
+        log.debug("✅ Game %s saved to database (ID: %s)", room, game_id)
         return True
-
     except Exception as e:
-        print(f"❌ Error saving game: {e}")
-        traceback.print_exc()
-        conn.rollback()
+        log.error("❌ Error saving game: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return False
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
 
-def update_user_stats(cur, user_id, winner, player_color):
-    """Update user statistics after game"""
-    placeholder = '%s' if USE_POSTGRES else '?'
-
-    try:
+if USE_POSTGRES:
+    # Row locks in id order before the update: the join order of
+    # UPDATE ... FROM (VALUES ...) isn't defined, so concurrent saves that
+    # share a player could otherwise lock the two rows in opposite orders.
+    # NO KEY UPDATE is the lock the UPDATE itself takes; unlike FOR UPDATE it
+    # doesn't conflict with the KEY SHARE locks the games foreign keys hold.
+    SQL_LOCK_USER_STATS = "SELECT id FROM users WHERE id = ANY(%s) ORDER BY id FOR NO KEY UPDATE"
+    # One statement per player count (a game has at most two registered players)
+    SQL_UPDATE_USER_STATS = {
+        n: f"""
+            UPDATE users u
+            SET games_played = u.games_played + 1,
+                games_won = u.games_won + v.won,
+                games_drawn = u.games_drawn + v.drawn,
+                games_lost = u.games_lost + v.lost,
+                elo_rating = CASE WHEN v.delta < 0
+                                  THEN GREATEST(u.elo_rating + v.delta, 800)
+                                  ELSE u.elo_rating + v.delta END
+            FROM (VALUES {", ".join(["(%s::int, %s::int, %s::int, %s::int, %s::int)"] * n)})
+                AS v(user_id, won, drawn, lost, delta)
+            WHERE u.id = v.user_id
+        """
+        for n in (1, 2)
+    }
+else:
+    # SQLite doesn't have GREATEST, use MAX
+    SQL_UPDATE_USER_STATS = """
+        UPDATE users
+        SET games_played = games_played + 1,
+            games_won = games_won + ?,
+            games_drawn = games_drawn + ?,
+            games_lost = games_lost + ?,
+            elo_rating = CASE WHEN ? < 0
+                              THEN MAX(elo_rating + ?, 800)
+                              ELSE elo_rating + ? END
+        WHERE id = ?
+    """
+
+def update_user_stats(cur, winner, players):
+    """Update statistics for every (user_id, color) in a finished game"""
+    rows = []
+    for user_id, player_color in players:
         if winner == 'draw':
-            cur.execute(f"""
-                UPDATE users
-                SET games_played = games_played + 1,
-                    games_drawn = games_drawn + 1
-                WHERE id = {placeholder}
-            """, (user_id,))
-            print(f"      → Draw recorded for user {user_id}")
+            rows.append((user_id, 0, 1, 0, 0))
         elif winner == player_color:
-            # Player won
-            cur.execute(f"""
-                UPDATE users
-                SET games_played = games_played + 1,
-                    games_won = games_won + 1,
-                    elo_rating = elo_rating + 20
-                WHERE id = {placeholder}
-            """, (user_id,))
-            print(f"      → Win recorded for user {user_id} (+20 ELO)")
+            rows.append((user_id, 1, 0, 0, 20))
         else:
-            # Player lost
-            if USE_POSTGRES:
-                cur.execute(f"""
-                    UPDATE users
-                    SET games_played = games_played + 1,
-                        games_lost = games_lost + 1,
-                        elo_rating = GREATEST(elo_rating - 15, 800)
-                    WHERE id = {placeholder}
-                """, (user_id,))
-            else:
-                # SQLite doesn't have GREATEST, use MAX
-                cur.execute(f"""
-                    UPDATE users
-                    SET games_played = games_played + 1,
-                        games_lost = games_lost + 1,
-                        elo_rating = MAX(elo_rating - 15, 800)
-                    WHERE id = {placeholder}
-                """, (user_id,))
-            print(f"      → Loss recorded for user {user_id} (-15 ELO)")
-    except Exception as e:
-        print(f"❌ Error in update_user_stats: {e}")
-        traceback.print_exc()
-        raise
+            rows.append((user_id, 0, 0, 1, -15))
+    if len(rows) == 2 and rows[0][0] == rows[1][0]:
+        # One user on both sides: count the game once, with no result or
+        # rating change. PostgreSQL's UPDATE ... FROM would apply only one of
+        # two VALUES rows for the same user while SQLite applied both.
+        rows = [(rows[0][0], 0, 0, 0, 0)]
+    if not rows:
+        return
+    log.debug("📊 Stats rows (user_id, won, drawn, lost, elo delta): %s", rows)
 
-def get_user_games(username):
-    """Get game history for a user"""
-    conn = get_db_conn()
     try:
         if USE_POSTGRES:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
+            if len(rows) == 2:
+                cur.execute(SQL_LOCK_USER_STATS, ([row[0] for row in rows],))
+            # Both players in one statement: join users against a VALUES list
+            cur.execute(SQL_UPDATE_USER_STATS[len(rows)], [value for row in rows for value in row])
         else:
-            cur = conn.cursor()
+            cur.executemany(SQL_UPDATE_USER_STATS, [(won, drawn, lost, delta, delta, delta, user_id)
+                                                    for user_id, won, drawn, lost, delta in rows])
+    except Exception as e:
+        log.error("❌ Error in update_user_stats: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
+        raise
+
+GAME_HISTORY_COLUMNS = """
+    id, room_code, white_player, black_player,
+    winner, win_reason, game_mode, time_control,
+    start_time, end_time, move_count, white_user_id, black_user_id
+"""
 
-        # Get user ID
+USER_GAMES_PAGE_SIZE = 50
+
+def user_games_sql(page_filter=""):
+    """Game history query; page_filter narrows both index scans (keyset paging)"""
+    # One ordered, limited index scan per colour (idx_games_white_user /
+    # idx_games_black_user) merged afterwards; an OR across both columns would
+    # scan and sort every game the user ever played. Self-play rows are taken
+    # from the white side only.
+    return f"""
+        SELECT id, room_code, white_player, black_player,
+               winner, win_reason, game_mode, time_control,
+               start_time, end_time, move_count,
+               CASE WHEN white_user_id = {PH} THEN {PH} ELSE 'Opponent' END AS white_username,
+               CASE WHEN black_user_id = {PH} THEN {PH} ELSE 'Opponent' END AS black_username
+        FROM (
+            SELECT * FROM (
+                SELECT {GAME_HISTORY_COLUMNS} FROM games
+                WHERE white_user_id = {PH} {page_filter}
+                ORDER BY end_time DESC, id DESC LIMIT {USER_GAMES_PAGE_SIZE}
+            ) AS as_white
+            UNION ALL
+            SELECT * FROM (
+                SELECT {GAME_HISTORY_COLUMNS} FROM games
+                WHERE black_user_id = {PH} AND COALESCE(white_user_id, 0) <> {PH} {page_filter}
+                ORDER BY end_time DESC, id DESC LIMIT {USER_GAMES_PAGE_SIZE}
+            ) AS as_black
+        ) AS user_games
+        ORDER BY end_time DESC, id DESC
+        LIMIT {USER_GAMES_PAGE_SIZE}
+    """
+
+SQL_GET_USER_GAMES = user_games_sql()
+# Keyset on (end_time, id): id breaks ties between games that ended in the
+# same second, so none are skipped at a page boundary
+SQL_GET_USER_GAMES_BEFORE = user_games_sql(f"AND (end_time, id) < ({PH}, {PH})")
+
+@retry_on_db_error
+def get_user_games(username, before=None):
+    """Get a page of game history for a user; `before` is the (end_time, id) of the last game already shown"""
+    try:
+        # Resolve the user first (usually from the user cache) so this call
+        # never holds two pooled connections at once
         user = get_user_by_username(username)
         if not user:
             return None
-
         user_id = user['id']
-        placeholder = '%s' if USE_POSTGRES else '?'
-
-        # Get games
-        cur.execute(f"""
-            SELECT id, room_code, white_player, black_player,
-                   winner, win_reason, game_mode, time_control,
-                   start_time, end_time, move_count,
-                   white_user_id, black_user_id
-            FROM games
-            WHERE white_user_id = {placeholder} OR black_user_id = {placeholder}
-            ORDER BY end_time DESC
-            LIMIT 50
-        """, (user_id, user_id))
-
-        games_list = []
-        for row in cur.fetchall():
-            row_dict = dict(row)
-            games_list.append({
-                'id': row_dict['id'],
-                'room_code': row_dict['room_code'],
-                'white_player': row_dict['white_player'],
-                'black_player': row_dict['black_player'],
-                'winner': row_dict['winner'],
-                'win_reason': row_dict['win_reason'],
-                'game_mode': row_dict['game_mode'],
-                'time_control': row_dict['time_control'],
-                'start_time': row_dict['start_time'],
-                'end_time': row_dict['end_time'],
-                'move_count': row_dict['move_count'],
-                'white_username': username if row_dict['white_user_id'] == user_id else 'Opponent',
-                'black_username': username if row_dict['black_user_id'] == user_id else 'Opponent'
-            })
-
-        return games_list
 
+        with db_cursor(read_only=True) as cur:
+            # Get games
+            if before is None:
+                cur.execute(SQL_GET_USER_GAMES, (user_id, username, user_id, username, user_id, user_id, user_id))
+            else:
+                cur.execute(SQL_GET_USER_GAMES_BEFORE, (user_id, username, user_id, username,
+                                                        user_id, *before, user_id, user_id, *before))
+
+            return cur.fetchall()
     except Exception as e:
-        print(f"❌ Error getting user games: {e}")
-        traceback.print_exc()
+        log.error("❌ Error getting user games: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return []
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
 
+SQL_GET_REPLAY_GAME = f"""
+    SELECT id, room_code, white_player, black_player, winner, win_reason,
+           game_mode, time_control, start_time, end_time
+    FROM games WHERE id = {PH}
+"""
+SQL_GET_REPLAY_MOVES = f"""
+    SELECT move_number, move_notation, from_square, to_square,
+           position_fen, white_time_remaining AS white_time,
+           black_time_remaining AS black_time
+    FROM game_moves
+    WHERE game_id = {PH}
+    ORDER BY move_number
+"""
+
+@retry_on_db_error
 def get_game_replay(game_id):
     """Get game replay data including all moves"""
-    conn = get_db_conn()
     try:
-        if USE_POSTGRES:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-        else:
-            cur = conn.cursor()
-
-        placeholder = '%s' if USE_POSTGRES else '?'
-
-        # Get game info
-        cur.execute(f"""
-            SELECT room_code, white_player, black_player, winner, win_reason,
-                   game_mode, time_control, start_time, end_time
-            FROM games WHERE id = {placeholder}
-        """, (game_id,))
-
-        game_row = cur.fetchone()
-        if not game_row:
-            return None
-
-        game_dict = dict(game_row)
-
-        # Get moves
-        cur.execute(f"""
-            SELECT move_number, move_notation, from_square, to_square,
-                   position_fen, white_time_remaining, black_time_remaining
-            FROM game_moves
-            WHERE game_id = {placeholder}
-            ORDER BY move_number
-        """, (game_id,))
-
-        moves = []
-        for row in cur.fetchall():
-            row_dict = dict(row)
-            moves.append({
-                'move_number': row_dict['move_number'],
-                'move_notation': row_dict['move_notation'],
-                'from_square': row_dict['from_square'],
-                'to_square': row_dict['to_square'],
-                'position_fen': row_dict['position_fen'],
-                'white_time': row_dict['white_time_remaining'],
-                'black_time': row_dict['black_time_remaining']
-            })
-
-        return {
-            'game': {
-                'id': game_id,
-                'room_code': game_dict['room_code'],
-                'white_player': game_dict['white_player'],
-                'black_player': game_dict['black_player'],
-                'winner': game_dict['winner'],
-                'win_reason': game_dict['win_reason'],
-                'game_mode': game_dict['game_mode'],
-                'time_control': game_dict['time_control'],
-                'start_time': game_dict['start_time'],
-                'end_time': game_dict['end_time']
-            },
-            'moves': moves
-        }
-
+        with db_cursor(read_only=True) as cur:
+            if USE_POSTGRES:
+                # Send both queries in one round-trip; the moves come back on
+                # their own cursor
+                moves_cur = cur.connection.cursor()
+                with cur.connection.pipeline():
+                    cur.execute(SQL_GET_REPLAY_GAME, (game_id,))
+                    moves_cur.execute(SQL_GET_REPLAY_MOVES, (game_id,))
+                game = cur.fetchone()
+                moves = moves_cur.fetchall()
+            else:
+                cur.execute(SQL_GET_REPLAY_GAME, (game_id,))
+                game = cur.fetchone()
+                if game:
+                    cur.execute(SQL_GET_REPLAY_MOVES, (game_id,))
+                    moves = cur.fetchall()
+
+            if not game:
+                return None
+            return {
+                'game': game,
+                'moves': moves
+            }
     except Exception as e:
-        print(f"❌ Error getting game replay: {e}")
-        traceback.print_exc()
+        log.error("❌ Error getting game replay: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return None
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)
 
+SQL_GET_LEADERBOARD_DATA = f"""
+    SELECT username, display_name, elo_rating,
+           games_played, games_won, games_drawn, games_lost
+    FROM users
+    WHERE games_played > 0
+    ORDER BY elo_rating DESC
+    LIMIT {PH}
+"""
+
+@retry_on_db_error
 def get_leaderboard_data(limit=10):
     """Get top players by ELO rating"""
-    conn = get_db_conn()
+    with user_cache_lock:
+        entry = leaderboard_cache.get(limit)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
     try:
-        if USE_POSTGRES:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-        else:
-            cur = conn.cursor()
-
-        placeholder = '%s' if USE_POSTGRES else '?'
-        cur.execute(f"""
-            SELECT username, display_name, elo_rating,
-                   games_played, games_won, games_drawn, games_lost
-            FROM users
-            WHERE games_played > 0
-            ORDER BY elo_rating DESC
-            LIMIT {placeholder}
-        """, (limit,))
-
-        leaderboard = []
-        for row in cur.fetchall():
-            row_dict = dict(row)
-            leaderboard.append({
-                'username': row_dict['username'],
-                'display_name': row_dict['display_name'],
-                'elo_rating': row_dict['elo_rating'],
-                'games_played': row_dict['games_played'],
-                'games_won': row_dict['games_won'],
-                'games_drawn': row_dict['games_drawn'],
-                'games_lost': row_dict['games_lost']
-            })
-
-        return leaderboard
-
+        with db_cursor(read_only=True) as cur:
+            cur.execute(SQL_GET_LEADERBOARD_DATA, (limit,))
+            rows = cur.fetchall()
+        with user_cache_lock:
+            leaderboard_cache[limit] = (time.monotonic() + USER_CACHE_TTL, rows)
+        return rows
     except Exception as e:
-        print(f"❌ Error getting leaderboard: {e}")
-        traceback.print_exc()
+        log.error("❌ Error getting leaderboard: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
         return []
-    finally:
-        if USE_POSTGRES:
-            release_db_conn(conn)